@@ -1,4 +1,5 @@
-import json
+from intent_module import classify
+from serialization_module import dumps
 
 
 class AliceRequest:
@@ -10,6 +11,8 @@ class AliceRequest:
      Методы
          user_id - возвращает user_id пользователя, который отправил запрос.
          words - возвращает все слова, произнесенные пользователем.
+         intents - возвращает множество намерений пользователя (см. intent_module), слова
+             классифицируются один раз на запрос.
          is_new_session - возвращает True если пользователь только начал диалог, иначе False.
          session - возвращает текущую сессия пользователя.
          version - возвращает текушую версию Алисы.
@@ -19,10 +22,19 @@ class AliceRequest:
          numbers - возращает список чисел, которые написал пользователь.
          dates  - возвращает список дат, которые написал пользователь.
 
-         foreign_words - возвращает список слов, написанных не на русском языке, для переводчика."""
+         foreign_words - возвращает список слов, написанных не на русском языке, для переводчика.
+     --------------------------------------------------------------------------------------
+     Производные данные (сущности по типам, намерения, иностранные слова)
+     вычисляются при первом обращении и запоминаются, поэтому возвращаемые списки и словари
+     нельзя изменять."""
+
+    __slots__ = ('_request', '_entities', '_intents', '_foreign_words')
 
     def __init__(self, request) -> None:
         self._request = request
+        self._entities = None
+        self._intents = None
+        self._foreign_words = None
 
     def __get_entity(self, entity_type) -> list:
         """Функця для получения определенных сущностей в зависимости от аргумента функции.
@@ -35,12 +47,14 @@ class AliceRequest:
             YANDEX.DATETIME
         ----------------------------------------------------------------------------------------
         Возвращает список сущностей, у которых тип совпадает с заданным, или пустой список, если
-        таких сущностей не найдено."""
-        entities = []
-        for entity in self._request["request"]["nlu"]["entities"]:
-            if entity["type"] == entity_type:
-                entities.append(entity["value"])
-        return entities
+        таких сущностей не найдено. Сущности всех типов раскладываются по спискам за один проход
+        при первом вызове."""
+        if self._entities is None:
+            entities = {}
+            for entity in self._request["request"]["nlu"]["entities"]:
+                entities.setdefault(entity["type"], []).append(entity["value"])
+            self._entities = entities
+        return self._entities.get(entity_type, [])
 
     @property
     def user_id(self) -> str:
@@ -50,6 +64,12 @@ class AliceRequest:
     def words(self) -> list:
         return self._request["request"]["nlu"]["tokens"]
 
+    @property
+    def intents(self) -> frozenset:
+        if self._intents is None:
+            self._intents = classify(self.words)
+        return self._intents
+
     @property
     def is_new_session(self) -> bool:
         return bool(self._request["session"]["new"])
@@ -86,14 +106,13 @@ class AliceRequest:
     def foreign_words(self) -> list:
         """Функция возвращает список слов, написанных не на русском языке, или пустой список,
         если таких слов не найдено."""
-        foreign = []
-        for word in self._request["request"]["original_utterance"].split():
-            if not 1039 < (ord(word[0])) < 1105:
-                foreign.append(word)
-        return foreign
+        if self._foreign_words is None:
+            self._foreign_words = [word for word in self.request_string.split()
+                                   if not 1039 < ord(word[0]) < 1105]
+        return self._foreign_words
 
     def __str__(self):
-        return json.dumps(self._request)
+        return dumps(self._request).decode('utf-8')
 
     def __repr__(self):
         return self.__str__()
@@ -108,11 +127,15 @@ class AliceResponse:
     Методы
         set_answer() - задает ответ Алисы в текстовом формате.
         end_session() - закрывает сессию с пользователем.
-        to_json() - возвращает ответ Алисы в json формате.
+        to_bytes() - возвращает ответ Алисы в json формате в виде bytes. Ответ кодируется
+            один раз и кодируется заново, только если его изменили.
+        to_json() - то же самое в виде строки.
         set_suggests() - прикрепляет варианты ответа для пользователя (кнопки).
         set_image() - прикрепляет картинку к ответу.
     """
 
+    __slots__ = ('_response', '_body')
+
     def __init__(self, request: AliceRequest):
         """Конструктор класса принимает аргумента класса AliceRequest для установки версии и сессии
         для ответа."""
@@ -121,21 +144,31 @@ class AliceResponse:
             "session": request.session,
             "response": {"end_session": False},
         }
+        self._body = None
 
     def set_answer(self, answer):
         self._response["response"]["text"] = answer
+        self._body = None
 
     def end_session(self):
         self._response["response"]["end_session"] = True
+        self._body = None
+
+    def to_bytes(self) -> bytes:
+        if self._body is None:
+            self._body = dumps(self._response)
+        return self._body
 
-    def to_json(self):
-        return json.dumps(self._response)
+    def to_json(self) -> str:
+        return self.to_bytes().decode('utf-8')
 
     def set_suggests(self, suggests):
         self._response["response"]["buttons"] = suggests
+        self._body = None
 
     def set_image(self, image):
         self._response["response"]["card"] = image
+        self._body = None
 
     def __str__(self):
         return self.to_json()
@@ -0,0 +1,78 @@
+import logging
+
+from aiohttp import web
+
+from alice_module import *
+from context_module import ChoiceState, Context, HelloState, forecasts, images
+from deadline_module import REQUEST_BUDGET, Deadline
+from logging_module import record_traffic, setup_logging
+from metrics_module import is_local, metrics, tracing
+from serialization_module import CONTENT_TYPE, dumps, loads
+from session_module import create_session_store
+from weather_module import WEATHER_REFRESH_TOP
+from upstream_module import upstream
+
+setup_logging()
+
+sessions = create_session_store()
+metrics.register("sessions", lambda: len(sessions))
+if WEATHER_REFRESH_TOP:
+    forecasts.start_refresher()
+# Сразу просматриваем память навыка: картинки, оставленные прошлым запуском, никто не учитывает
+images.start_reaper()
+
+
+async def main(request: web.Request) -> web.Response:
+    """Асинхронная версия main.main: пока одно состояние ждет ответа внешнего API,
+    event loop обслуживает запросы других пользователей."""
+    with tracing("X-Trace" in request.headers) as trace, metrics.timer("request", "post"):
+        response = await handle_post(request)
+    if trace is not None:
+        response.headers["X-Trace"] = dumps(trace.to_dict()).decode("utf-8")
+    return response
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    """Метрики процесса в JSON, доступны только с этой же машины."""
+    if not is_local(request.remote, request.headers):
+        raise web.HTTPNotFound()
+    return web.Response(body=dumps(metrics.snapshot()), content_type=CONTENT_TYPE)
+
+
+async def handle_post(request: web.Request) -> web.Response:
+    deadline = Deadline(REQUEST_BUDGET)
+    body = await request.read()
+    text = body.decode("utf-8")
+    logging.info("Req: %s", text)
+    record_traffic(text)
+
+    alice_req = AliceRequest(loads(body))
+    alice_resp = AliceResponse(alice_req)
+    session = None if alice_req.is_new_session else await sessions.get_async(alice_req.user_id)
+    if session is None:
+        # Новая сессия или сессия вытеснена из хранилища: новому пользователю здороваемся,
+        # а вернувшегося сразу отправляем выбирать функцию.
+        cnt = Context(HelloState() if alice_req.is_new_session else ChoiceState())
+    else:
+        cnt = Context.from_dict(session)
+    await cnt.handle_dialog_async(alice_resp, alice_req, deadline)
+    data = cnt.to_dict()
+    await sessions.set_async(alice_req.user_id, data)
+    body = alice_resp.to_bytes()
+    logging.info("Resp: %s", alice_resp,
+                 extra={"user_id": alice_req.user_id, "state": data["s"]})
+    return web.Response(body=body, content_type=CONTENT_TYPE)
+
+
+async def on_cleanup(app: web.Application):
+    await upstream.close_async()
+
+
+app = web.Application()
+app.router.add_post("/post", main)
+app.router.add_get("/metrics", metrics_endpoint)
+app.on_cleanup.append(on_cleanup)
+
+
+if __name__ == "__main__":
+    web.run_app(app, port=8989)
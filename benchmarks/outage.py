@@ -0,0 +1,74 @@
+"""Проверка восстановления после отказа VirusTotal: заглушка из benchmarks.replay отвечает
+ошибкой 500, пока предохранитель VirusTotal не разомкнется, затем начинает отвечать нормально.
+После паузы cooldown следующая ссылка должна уйти пробным запросом, получить вердикт
+и замкнуть предохранитель, а ссылки, проверка которых сорвалась при отказе, не должны остаться
+в кэше неудачными вердиктами.
+
+Запуск:
+    python -m benchmarks.outage --cooldown 1"""
+import argparse
+import os
+import time
+
+from benchmarks.replay import StubHandler, start_stub, stub_environ
+
+
+def wait_verdict(scanner, url: str, timeout: float):
+    """Спрашивает вердикт, пока фоновая проверка не закончится, и возвращает его или ошибку
+    сорвавшейся проверки."""
+    from scanner_module import SCANNING
+    from upstream_module import UpstreamError
+
+    stop = time.monotonic() + timeout
+    try:
+        verdict = scanner.verdict(url)
+        while verdict is SCANNING and time.monotonic() < stop:
+            time.sleep(0.2)
+            verdict = scanner.verdict(url)
+    except UpstreamError as e:
+        return e
+    return verdict
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cooldown', type=float, default=1.0)
+    parser.add_argument('--failures', type=int, default=3)
+    args = parser.parse_args()
+
+    stub = start_stub(0.0, 1.0)
+    os.environ.update(stub_environ(stub.server_address[1], keep_quotas=False))
+    os.environ['BREAKER_FAILURES'] = str(args.failures)
+    os.environ['BREAKER_COOLDOWN'] = str(args.cooldown)
+
+    from scanner_module import UrlScanner
+    from upstream_module import CircuitOpen, UpstreamError, upstream
+
+    scanner = UrlScanner('benchmark', poll_timeout=10)
+    breaker = upstream.breaker('virustotal')
+    for i in range(args.failures):
+        verdict = wait_verdict(scanner, f'https://outage-{i}.example.com/', 10)
+        assert isinstance(verdict, UpstreamError), verdict
+    assert breaker.stats()['state'] == 'open', breaker.stats()
+    try:
+        scanner.verdict('https://rejected.example.com/')
+        raise AssertionError('предохранитель пропустил запрос')
+    except CircuitOpen:
+        pass
+    print(f'отказ: предохранитель разомкнут после {args.failures} ошибок')
+
+    StubHandler.error_rate = 0.0
+    time.sleep(args.cooldown + 0.1)
+    verdict = wait_verdict(scanner, 'https://recovered.example.com/', 15)
+    assert isinstance(verdict, dict), verdict
+    assert breaker.stats()['state'] == 'closed', breaker.stats()
+    print(f'восстановление: пробный запрос прошел через {args.cooldown:.1f} с, вердикт {verdict}')
+    # Ссылка, проверка которой сорвалась при отказе, проверяется заново, а не берется из кэша
+    verdict = wait_verdict(scanner, 'https://outage-0.example.com/', 15)
+    assert isinstance(verdict, dict), verdict
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""Воспроизведение записанного трафика: прогоняет тела запросов Алисы через навык в этом же
+процессе, а внешние API подменяет заглушкой на локальном порту. Так бенчмарк не тратит квоты
+ключей, повторяется от запуска к запуску и позволяет добавить задержку и ошибки внешних API.
+
+Трафик записывается с боевого навыка переменной окружения RECORD_TRAFFIC=traffic.jsonl - по
+одному телу запроса на строку. Без записи можно сгенерировать синтетические диалоги:
+    python -m benchmarks.replay --synthesize 200 --traffic traffic.jsonl
+
+Запуск:
+    python -m benchmarks.replay --traffic traffic.jsonl --concurrency 16 --latency 50
+    python -m benchmarks.replay --traffic traffic.jsonl --error-rate 0.1 --memory
+
+Реплики одного пользователя отправляются по порядку, разные пользователи - параллельно.
+В конце выводятся пропускная способность, перцентили задержек, число ошибок, объем сессии
+в хранилище и (с --memory) прирост памяти процесса на одного пользователя.
+
+Чтобы прогнать трафик через отдельно запущенный сервер (например async_main.py), запустите
+только заглушку (--stub-only), запустите сервер с напечатанными переменными окружения и
+передайте его адрес в --url."""
+import argparse
+import os
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from serialization_module import dumps, loads
+
+UPSTREAM_NAMES = ('virustotal', 'geocoder', 'weather', 'static_maps', 'dialogs', 'translator')
+# Минимальный валидный PNG 1x1 - ответ статических карт
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                    '1f15c4890000000d49444154789c6360000000020001e221bc330000000049454e44ae426082')
+DIALOGS = [
+    ['', 'погода', 'Погода в Москве', 'спасибо'],
+    ['', 'переводчик', 'переведи hello world', 'выйти'],
+    ['', 'карты', 'Покажи Москве', 'выйти'],
+    ['', 'сканер', 'проверь ссылку https://example.com/login', 'выйти'],
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Отвечает на запросы ко всем внешним API так, как отвечают настоящие. Первая часть пути -
+    имя API из upstream_module, остальное - путь запроса к нему."""
+
+    latency = 0.0
+    error_rate = 0.0
+    # Ответ, которым заглушка изображает ошибку API
+    error_status = 500
+    error_body = b'{}'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body, content_type: str = 'application/json'):
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            self.send_response(self.error_status)
+            body = self.error_body
+        else:
+            self.send_response(200)
+            if not isinstance(body, bytes):
+                body = dumps(body)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+    def do_GET(self):
+        name, _, path = self.path.lstrip('/').partition('/')
+        if name == 'geocoder':
+            self._reply({'response': {'GeoObjectCollection': {'featureMember': [
+                {'GeoObject': {'Point': {'pos': '37.617635 55.755814'}}}]}}})
+        elif name == 'weather':
+            self._reply({'fact': {'temp': 12, 'feels_like': 9, 'condition': 'cloudy',
+                                  'wind_speed': 4}, 'yesterday': {'temp': 11}})
+        elif name == 'virustotal':
+            self._reply({'data': {'attributes': {'status': 'completed', 'results': {
+                'engine-1': {'result': 'clean'}, 'engine-2': {'result': 'unrated'}}}}})
+        elif name == 'static_maps':
+            self._reply(PNG, 'image/png')
+        elif name == 'dialogs':
+            self._reply({'images': []})
+        elif name == 'translator':
+            self._reply({'responseData': {'translatedText': 'привет мир'}})
+        else:
+            self._reply({})
+
+    def do_POST(self):
+        self._read_body()
+        name = self.path.lstrip('/').partition('/')[0]
+        if name == 'virustotal':
+            self._reply({'data': {'id': f'analysis-{random.getrandbits(32)}'}})
+        elif name == 'dialogs':
+            self._reply({'image': {'id': f'image-{random.getrandbits(32)}'}})
+        else:
+            self._reply({})
+
+    def do_DELETE(self):
+        self._reply({'result': 'ok'})
+
+
+def start_stub(latency: float, error_rate: float, port: int = 0) -> ThreadingHTTPServer:
+    StubHandler.latency = latency
+    StubHandler.error_rate = error_rate
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stub_environ(port: int, keep_quotas: bool) -> dict:
+    """Переменные окружения, которые направляют все внешние API в заглушку."""
+    environ = {}
+    for name in UPSTREAM_NAMES:
+        environ[f'UPSTREAM_{name.upper()}_URL'] = f'http://127.0.0.1:{port}/{name}'
+        if not keep_quotas:
+            environ[f'UPSTREAM_{name.upper()}_PER_MINUTE'] = '0'
+            environ[f'UPSTREAM_{name.upper()}_PER_DAY'] = '0'
+    return environ
+
+
+def synthesize(path: str, users: int):
+    from benchmarks.throughput import make_request
+
+    with open(path, 'wb') as file:
+        for i in range(users):
+            for turn, utterance in enumerate(DIALOGS[i % len(DIALOGS)]):
+                file.write(dumps(make_request(f'user-{i}', utterance, turn == 0)) + b'\n')
+
+
+def load_traffic(path: str, repeat: int) -> dict:
+    """Читает записанные тела запросов и группирует их по пользователям с сохранением порядка.
+    При repeat > 1 трафик каждого пользователя повторяется под новыми user_id."""
+    dialogs = {}
+    with open(path, 'rb') as file:
+        for line in file:
+            if line.strip():
+                body = loads(line)
+                dialogs.setdefault(body['session']['user_id'], []).append(body)
+    result = {}
+    for copy in range(repeat):
+        for user_id, bodies in dialogs.items():
+            replay_id = user_id if copy == 0 else f'{user_id}-{copy}'
+            result[replay_id] = [dict(body, session=dict(body['session'], user_id=replay_id))
+                                 for body in bodies]
+    return result
+
+
+def in_process_sender():
+    import main
+
+    local = threading.local()
+
+    def send(body: bytes) -> bool:
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = main.app.test_client()
+        return client.post('/post', data=body, content_type='application/json').status_code == 200
+
+    return send, main.sessions
+
+
+def http_sender(url: str):
+    def send(body: bytes) -> bool:
+        request = urllib.request.Request(url, data=body,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+                return response.status == 200
+        except OSError:
+            return False
+
+    return send, None
+
+
+def replay(dialogs: dict, send, concurrency: int):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run_user(bodies):
+        nonlocal errors
+        for body in bodies:
+            data = dumps(body)
+            started = time.perf_counter()
+            ok = send(data)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors += not ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(run_user, dialogs.values()))
+    return latencies, errors, time.perf_counter() - started
+
+
+def session_bytes(sessions, user_ids) -> float or None:
+    sizes = []
+    for user_id in user_ids:
+        data = sessions.get(user_id)
+        if data is not None:
+            sizes.append(len(dumps(data)))
+    return statistics.mean(sizes) if sizes else None
+
+
+def report(latencies: list, errors: int, elapsed: float):
+    latencies.sort()
+
+    def pct(q):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+
+    print(f'{len(latencies)} запросов за {elapsed:.2f} с, {len(latencies) / elapsed:.1f} запр/с, '
+          f'ошибок {errors}')
+    print(f'p50 {statistics.median(latencies) * 1000:.1f} мс, p95 {pct(0.95):.1f} мс, '
+          f'p99 {pct(0.99):.1f} мс, max {latencies[-1] * 1000:.1f} мс')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--traffic', default='traffic.jsonl')
+    parser.add_argument('--synthesize', type=int, metavar='USERS',
+                        help='записать синтетические диалоги в --traffic и выйти')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка заглушки, мс')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='доля ответов заглушки с кодом 500')
+    parser.add_argument('--keep-quotas', action='store_true',
+                        help='не отключать квоты ключей внешних API')
+    parser.add_argument('--memory', action='store_true',
+                        help='замерить прирост памяти на пользователя (tracemalloc)')
+    parser.add_argument('--url', help='адрес отдельно запущенного навыка вместо этого процесса')
+    parser.add_argument('--stub-only', action='store_true',
+                        help='только запустить заглушку и напечатать переменные окружения')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.synthesize:
+        synthesize(args.traffic, args.synthesize)
+        print(f'{args.traffic}: {args.synthesize} диалогов')
+        return
+
+    stub = start_stub(args.latency / 1000, args.error_rate, args.port)
+    environ = stub_environ(stub.server_address[1], args.keep_quotas)
+    if args.stub_only:
+        for key, value in environ.items():
+            print(f'export {key}={value}')
+        threading.Event().wait()
+    os.environ.update(environ)
+
+    dialogs = load_traffic(args.traffic, args.repeat)
+    if args.memory:
+        tracemalloc.start()
+    send, sessions = http_sender(args.url) if args.url else in_process_sender()
+    baseline = tracemalloc.get_traced_memory()[0] if args.memory else 0
+    latencies, errors, elapsed = replay(dialogs, send, args.concurrency)
+
+    print(f'{len(dialogs)} пользователей, параллельно {args.concurrency}, '
+          f'задержка заглушки {args.latency:.0f} мс, ошибки заглушки {args.error_rate:.0%}')
+    report(latencies, errors, elapsed)
+    if sessions is not None:
+        size = session_bytes(sessions, dialogs)
+        if size is not None:
+            print(f'сессия в хранилище: {size:.0f} байт')
+    if args.memory:
+        grown = tracemalloc.get_traced_memory()[0] - baseline
+        print(f'прирост памяти: {grown / len(dialogs):.0f} байт на пользователя')
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Микро-бенчмарк разбора запроса Алисы: сколько микросекунд уходит на AliceRequest за одну
+реплику при типичном для состояний навыка наборе обращений к его свойствам.
+
+Для сравнения замеряется LegacyRequest - прежняя реализация, которая заново проходит по всем
+сущностям при каждом обращении к geo_names и заново разбивает реплику в foreign_words.
+
+Запуск:
+    python -m benchmarks.request_parsing --number 20000"""
+import argparse
+import timeit
+
+from alice_module import AliceRequest
+from benchmarks.throughput import make_request
+from intent_module import classify
+
+UTTERANCES = [
+    'Погода в Москве',
+    'переведи hello world с английского на русский',
+    'проверь ссылку https://example.com/login?next=/account',
+    'покажи на карте Невский проспект 28 в Санкт-Петербурге',
+    'выйти',
+]
+
+
+def realistic_payload(utterance: str) -> dict:
+    """Тело запроса с набором сущностей, как их присылает Алиса для длинных реплик."""
+    payload = make_request('user-1', utterance, False)
+    payload['request']['nlu']['entities'] += [
+        {'type': 'YANDEX.NUMBER', 'value': 28, 'tokens': {'start': 0, 'end': 1}},
+        {'type': 'YANDEX.FIO', 'value': {'first_name': 'алиса'}, 'tokens': {'start': 0, 'end': 1}},
+        {'type': 'YANDEX.GEO', 'value': {'city': 'санкт-петербург', 'street': 'невский проспект',
+                                         'house_number': '28'},
+         'tokens': {'start': 0, 'end': 1}},
+        {'type': 'YANDEX.DATETIME', 'value': {'day': 1, 'day_is_relative': True},
+         'tokens': {'start': 0, 'end': 1}},
+    ]
+    return payload
+
+
+class LegacyRequest:
+    def __init__(self, request):
+        self._request = request
+
+    def _get_entity(self, entity_type):
+        return [entity['value'] for entity in self._request['request']['nlu']['entities']
+                if entity['type'] == entity_type]
+
+    @property
+    def words(self):
+        return self._request['request']['nlu']['tokens']
+
+    @property
+    def intents(self):
+        return classify(self.words)
+
+    @property
+    def geo_names(self):
+        return self._get_entity('YANDEX.GEO')
+
+    @property
+    def foreign_words(self):
+        return [word for word in self._request['request']['original_utterance'].split()
+                if not 1039 < ord(word[0]) < 1105]
+
+    @property
+    def user_id(self):
+        return self._request['session']['user_id']
+
+
+def one_turn(request_class, payload):
+    """Обращения к запросу, которые делают main и состояние за одну реплику."""
+    req = request_class(payload)
+    req.user_id
+    for _ in range(3):
+        req.intents
+    for _ in range(2):
+        req.geo_names
+        req.foreign_words
+    req.words
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    payloads = [realistic_payload(utterance) for utterance in UTTERANCES]
+    for request_class in (LegacyRequest, AliceRequest):
+        elapsed = min(timeit.repeat(lambda: [one_turn(request_class, p) for p in payloads],
+                                    number=args.number // len(payloads), repeat=5))
+        per_request = elapsed / (args.number // len(payloads) * len(payloads)) * 1e6
+        print(f'{request_class.__name__}: {per_request:.2f} мкс на реплику')
+
+
+if __name__ == '__main__':
+    main()
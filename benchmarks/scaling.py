@@ -0,0 +1,104 @@
+"""Нагрузочный тест горизонтального масштабирования: запускает навык в gunicorn с разным числом
+процессов и общим хранилищем сессий, гоняет диалоги многих пользователей и выводит пропускную
+способность для каждого числа процессов.
+
+Диалог состоит только из переходов между состояниями и заодно проверяет, что любой процесс
+продолжает диалог пользователя с правильного состояния. Переходы все же запускают фоновые
+запросы к внешним API (предзагрузку погоды и карт, просмотр памяти навыка при старте), поэтому
+процессы gunicorn направляются в заглушку из benchmarks.replay: тест не тратит квоты ключей
+и не нагружает настоящие сервисы.
+
+Запуск:
+    python -m benchmarks.scaling --workers 1 2 4 --users 200 --rounds 5"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks.replay import start_stub, stub_environ
+from benchmarks.throughput import make_request
+
+DIALOG = [
+    ('', 'Привет'),
+    ('погода', 'Хорошо, пиши место'),
+    ('выход', 'У нас есть несколько функций'),
+    ('сканер', 'Хорошо, отправь ссылку'),
+    ('выход', 'У нас есть несколько функций'),
+    ('переводчик', 'Хорошо, давай переводить'),
+    ('выход', 'У нас есть несколько функций'),
+]
+
+
+def wait_for_port(port: int, timeout: float = 15):
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+async def run_user(session, url, user_id, rounds, stats):
+    for _ in range(rounds):
+        for i, (utterance, expected) in enumerate(DIALOG):
+            async with session.post(url, json=make_request(user_id, utterance, i == 0)) as resp:
+                answer = (await resp.json())['response'].get('text', '')
+            stats['requests'] += 1
+            if not answer.startswith(expected):
+                stats['wrong'] += 1
+
+
+async def load(url: str, users: int, rounds: int) -> dict:
+    stats = {'requests': 0, 'wrong': 0}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=users)) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*[run_user(session, url, f'user-{i}', rounds, stats)
+                               for i in range(users)])
+        stats['elapsed'] = time.perf_counter() - started
+    return stats
+
+
+def run(workers: int, users: int, rounds: int, port: int, app: str, stub_env: dict) -> dict:
+    env = dict(os.environ, **stub_env, SESSION_STORE='sqlite',
+               SESSION_DB=os.path.join(tempfile.mkdtemp(), 'sessions.db'),
+               WORKERS=str(workers), BIND=f'127.0.0.1:{port}')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', app],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        return asyncio.run(load(f'http://127.0.0.1:{port}/post', users, rounds))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8990)
+    parser.add_argument('--app', default='main:app')
+    args = parser.parse_args()
+
+    stub = start_stub(0.0, 0.0)
+    stub_env = stub_environ(stub.server_address[1], keep_quotas=False)
+    base = None
+    for workers in args.workers:
+        stats = run(workers, args.users, args.rounds, args.port, args.app, stub_env)
+        rps = stats['requests'] / stats['elapsed']
+        base = base or rps / workers
+        print(f'workers={workers}: {rps:.0f} запр/с, ускорение x{rps / base:.2f} '
+              f'(идеально x{workers}), неверных переходов: {stats["wrong"]}')
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
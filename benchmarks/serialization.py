@@ -0,0 +1,71 @@
+"""Бенчмарк сериализации вебхука: сколько процессорного времени на реплику уходит на разбор тела
+запроса Алисы, запись запроса и ответа в лог и кодирование ответа.
+
+old - как раньше: тело разбирается json.loads, в лог пишется f-строка со всем словарем запроса,
+    ответ кодируется json.dumps в логе и еще раз для возврата.
+new - как сейчас: тело разбирается один раз (orjson, если установлен), ответ кодируется один раз
+    и переиспользуется для лога и возврата.
+
+Запуск:
+    python -m benchmarks.serialization --number 20000"""
+import argparse
+import json
+import timeit
+
+from alice_module import AliceRequest, AliceResponse
+from serialization_module import BACKEND, loads
+
+BODY = json.dumps({
+    'meta': {'locale': 'ru-RU', 'timezone': 'Europe/Moscow', 'client_id': 'ru.yandex.searchplugin',
+             'interfaces': {'screen': {}, 'payments': {}, 'account_linking': {}}},
+    'session': {'message_id': 3, 'session_id': 'f2a5d8e4-9b1c-4d7e-8f3a-2c6b0e1d9a7f',
+                'skill_id': 'benchmark', 'user_id': 'A3B9C2D7E1F04A5B8C6D9E2F1A0B3C4D5E6F7A8B',
+                'application': {'application_id': 'E1F2A3B4C5D6E7F8A9B0C1D2E3F4A5B6'},
+                'new': False},
+    'request': {'command': 'погода в москве', 'original_utterance': 'Погода в Москве',
+                'type': 'SimpleUtterance', 'markup': {'dangerous_context': False},
+                'nlu': {'tokens': ['погода', 'в', 'москве'],
+                        'entities': [{'type': 'YANDEX.GEO', 'value': {'city': 'москва'},
+                                      'tokens': {'start': 2, 'end': 3}}],
+                        'intents': {}}},
+    'version': '1.0',
+}, ensure_ascii=False).encode('utf-8')
+ANSWER = ('СЕГОДНЯ:\n Температура: 12°C, ощущается как 9°C; \nУсловия: облачно с прояснениями, '
+          '\nВетер: 4 м/с;\nЗАВТРА: \nТемпература: 11°C')
+SUGGESTS = [{'title': 'Выйти', 'hide': True}]
+
+
+def old_turn(body: bytes, log: list):
+    request_json = json.loads(body)
+    log.append(f'Req: {request_json}')
+    response = {'version': request_json['version'], 'session': request_json['session'],
+                'response': {'end_session': False, 'text': ANSWER, 'buttons': SUGGESTS}}
+    log.append(f'Resp: {json.dumps(response)}')
+    return json.dumps(response)
+
+
+def new_turn(body: bytes, log: list):
+    log.append(('Req: %s', body.decode('utf-8')))
+    alice_resp = AliceResponse(AliceRequest(loads(body)))
+    alice_resp.set_answer(ANSWER)
+    alice_resp.set_suggests(SUGGESTS)
+    response_body = alice_resp.to_bytes()
+    log.append(('Resp: %s', str(alice_resp)))
+    return response_body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f'JSON backend: {BACKEND}')
+    for name, turn in (('old', old_turn), ('new', new_turn)):
+        log = []
+        elapsed = min(timeit.repeat(lambda: turn(BODY, log), number=args.number, repeat=5))
+        log.clear()
+        print(f'{name}: {elapsed / args.number * 1e6:.2f} мкс на реплику')
+
+
+if __name__ == '__main__':
+    main()
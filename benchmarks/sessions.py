@@ -0,0 +1,141 @@
+"""Бенчмарк памяти на одну активную сессию: сколько байт занимает пользователь, пока его
+диалог обрабатывается (живые объекты контекста и состояния), и пока он ждет следующей реплики
+(сериализованная сессия в MemorySessionStore).
+
+old - как раньше: на каждого пользователя создаются Context и объект его состояния, оба со своим
+    __dict__ и ссылкой друг на друга, данные состояния сохраняются в сессии вложенным словарем.
+new - как сейчас: состояния - общие объекты без данных, пользователь - запись Context
+    в __slots__ (состояние и сущности).
+
+Новая запись экономит память живых объектов (около 190 -> 80 байт на сессию), а в хранилище
+обе раскладки занимают около 300 байт: new чуть больше, потому что хранит входные данные
+ожидающих запросов, которые old держал в late_results. Основную экономию в хранилище дала
+обрезка запаса, который orjson оставляет в возвращаемых bytes (encode_session): без нее
+сессия занимает около 1.3 КБ при любой раскладке - это показывает строка untrimmed.
+
+Запуск:
+    python -m benchmarks.sessions --sessions 100000"""
+import argparse
+import gc
+import timeit
+import tracemalloc
+
+import session_module
+from context_module import STATES, Context
+from serialization_module import dumps
+from session_module import MemorySessionStore
+
+# Типичная смесь сессий: большинство пользователей выбирает функцию или ждет следующей
+# реплики, часть ждет ответа, который не успел подготовиться (прогноза, карты, перевода
+# или проверки ссылок)
+MIX = [
+    {'s': 'ChoiceState'},
+    {'s': 'WeatherState'},
+    {'s': 'WeatherState', 'e': ['москва']},
+    {'s': 'MapsState'},
+    {'s': 'MapsState', 'e': ['санкт-петербург', 'казань']},
+    {'s': 'TranslatorState'},
+    {'s': 'TranslatorState', 'e': ['доброе утро', 'ru', 'en']},
+    {'s': 'ScanUrlState'},
+    {'s': 'ScanUrlState', 'e': ['https://example.com/login?next=/account']},
+]
+
+
+class LegacyState:
+    def __init__(self, name: str, pending_urls: tuple = ()):
+        self.name = name
+        self._context = None
+        if pending_urls:
+            self._ScanUrlState__pending_urls = pending_urls
+
+    def dump(self) -> dict:
+        urls = getattr(self, '_ScanUrlState__pending_urls', ())
+        return {'u': list(urls)} if urls else {}
+
+
+class LegacyContext:
+    """Прежний контекст: объект с __dict__, который создает свой объект состояния."""
+
+    def __init__(self, state: LegacyState):
+        self._state = state
+        self._state._context = self
+
+    def to_dict(self) -> dict:
+        data = {'s': self._state.name}
+        payload = self._state.dump()
+        if payload:
+            data['d'] = payload
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(LegacyState(data['s'], tuple(data.get('d', {}).get('u', ()))))
+
+
+def legacy_session(data: dict) -> dict:
+    # Прежде в сессии хранились только ссылки, остальное ожидание держал late_results процесса
+    if 'e' not in data:
+        return data
+    return {'s': data['s'], 'd': {'u': data['e']}} if data['s'] == 'ScanUrlState' else {'s': data['s']}
+
+
+def allocated(make, count: int) -> float:
+    """Байт на объект, которые остаются занятыми, пока живы count объектов make(i)."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make(i) for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objects
+    return used / count
+
+
+def stored(sessions: list, trim: bool = True) -> float:
+    """Байт на сессию в MemorySessionStore. С trim=False сессии кодируются как до обрезки
+    запаса orjson в encode_session."""
+    store = MemorySessionStore(max_bytes=1 << 40)
+    encode = session_module.encode_session
+    if not trim:
+        session_module.encode_session = dumps
+    try:
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i, data in enumerate(sessions):
+            store.set(f'user-{i:040d}', data)
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+    finally:
+        session_module.encode_session = encode
+    return used / len(sessions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    assert set(data['s'] for data in MIX) <= set(STATES)
+    legacy_mix = [legacy_session(data) for data in MIX]
+    count = args.sessions
+    rows = (
+        ('old', lambda i: LegacyContext.from_dict(legacy_mix[i % len(MIX)]), legacy_mix,
+         LegacyContext),
+        ('new', lambda i: Context.from_dict(MIX[i % len(MIX)]), MIX, Context),
+    )
+    for name, make, mix, context in rows:
+        live = allocated(make, count)
+        at_rest = stored([mix[i % len(mix)] for i in range(count)])
+        turn = min(timeit.repeat(lambda: [context.from_dict(data).to_dict() for data in mix],
+                                 number=args.number // len(mix), repeat=3))
+        print(f'{name}: {live:.0f} байт на сессию в обработке, {at_rest:.0f} байт на сессию '
+              f'в хранилище, {turn / args.number * 1e6:.2f} мкс на from_dict + to_dict')
+    untrimmed = stored([MIX[i % len(MIX)] for i in range(count)], trim=False)
+    print(f'untrimmed: {untrimmed:.0f} байт на сессию в хранилище без обрезки запаса orjson')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Нагрузочный тест вебхука навыка: отправляет запросы от многих пользователей одновременно
+и выводит пропускную способность и задержки.
+
+Запуск (сервер должен быть уже запущен, например `python main.py` или `python async_main.py`):
+    python -m benchmarks.throughput --url http://127.0.0.1:8989/post --users 50 --requests 10
+Можно передать несколько --url, чтобы сравнить синхронный и асинхронный режимы."""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+
+
+def make_request(user_id: str, utterance: str, new: bool) -> dict:
+    """Возвращает тело запроса Алисы для пользователя user_id."""
+    tokens = utterance.lower().split()
+    entities = []
+    if 'москве' in tokens:
+        entities.append({'type': 'YANDEX.GEO', 'value': {'city': 'москва'},
+                         'tokens': {'start': tokens.index('москве'),
+                                    'end': tokens.index('москве') + 1}})
+    return {
+        'version': '1.0',
+        'session': {'new': new, 'session_id': f'session-{user_id}', 'message_id': 0,
+                    'skill_id': 'benchmark', 'user_id': user_id},
+        'request': {'command': utterance.lower(), 'original_utterance': utterance,
+                    'type': 'SimpleUtterance',
+                    'nlu': {'tokens': tokens, 'entities': entities}},
+    }
+
+
+async def run_user(session: aiohttp.ClientSession, url: str, user_id: str, requests_count: int,
+                   latencies: list):
+    dialog = [('', True), ('погода', False)]
+    dialog += [('Погода в Москве', False)] * requests_count
+    for utterance, new in dialog:
+        started = time.perf_counter()
+        async with session.post(url, json=make_request(user_id, utterance, new)) as response:
+            await response.read()
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(url: str, users: int, requests_count: int):
+    latencies = []
+    connector = aiohttp.TCPConnector(limit=users)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*[run_user(session, url, f'user-{i}', requests_count, latencies)
+                               for i in range(users)])
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f'{url}: {len(latencies)} запросов за {elapsed:.2f} с, '
+          f'{len(latencies) / elapsed:.1f} запр/с, '
+          f'p50 {statistics.median(latencies) * 1000:.0f} мс, '
+          f'p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} мс')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', action='append', required=True)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=10)
+    args = parser.parse_args()
+    for url in args.url:
+        asyncio.run(run(url, args.users, args.requests))
+
+
+if __name__ == '__main__':
+    main()
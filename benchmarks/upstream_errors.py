@@ -0,0 +1,65 @@
+"""Проверка ответов внешних API с ошибкой: заглушка из benchmarks.replay отвечает переводчику
+кодом 429 с JSON-телом ошибки RapidAPI (без responseData). Перевод должен завершиться
+UpstreamError, а не KeyError, ошибка не должна попасть в кэш переводов, а реплика
+пользователя - получить ответ "переводчик недоступен" вместо HTTP 500.
+
+Запуск:
+    python -m benchmarks.upstream_errors"""
+import argparse
+import asyncio
+import os
+
+from benchmarks.replay import StubHandler, start_stub, stub_environ
+from serialization_module import dumps, loads
+
+RATE_LIMITED = dumps({'message': 'You have exceeded the rate limit per minute for your plan, '
+                                 'BASIC, by the API provider'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--status', type=int, default=429)
+    args = parser.parse_args()
+
+    stub = start_stub(0.0, 1.0)
+    StubHandler.error_status = args.status
+    StubHandler.error_body = RATE_LIMITED
+    os.environ.update(stub_environ(stub.server_address[1], keep_quotas=False))
+    # Ошибки в этой проверке не должны размыкать предохранитель переводчика
+    os.environ['BREAKER_FAILURES'] = '1000'
+
+    from benchmarks.throughput import make_request
+    from translator_module import TranslationService
+    from upstream_module import UpstreamError, upstream
+
+    async def translate_async(text: str) -> str:
+        try:
+            return await translator.translate_async(text)
+        finally:
+            await upstream.close_async()
+
+    translator = TranslationService('benchmark')
+    for translate in (translator.translate, lambda text: asyncio.run(translate_async(text))):
+        try:
+            translate('привет мир')
+            raise AssertionError('ответ с ошибкой принят за перевод')
+        except UpstreamError as e:
+            print(f'{args.status}: {e}')
+    assert translator.stats()['memory']['size'] == 0, translator.stats()
+
+    import main
+
+    client = main.app.test_client()
+    for turn, utterance in enumerate(['', 'переводчик', 'переведи hello world']):
+        response = client.post('/post', data=dumps(make_request('benchmark', utterance, turn == 0)),
+                               content_type='application/json')
+        assert response.status_code == 200, response.status_code
+    answer = loads(response.data)['response']['text']
+    assert 'недоступен' in answer, answer
+    print(f'реплика: {answer}')
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
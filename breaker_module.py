@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+
+# Сколько ошибок подряд размыкает предохранитель и сколько секунд он остается разомкнутым
+# перед пробным запросом
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# allow() возвращает PROBE для пробного запроса: его результат передается в record и cancel
+# с probe=True, чтобы поздние ответы запросов, отправленных до размыкания, не завершили пробу
+PROBE = 'probe'
+
+
+class CircuitBreaker:
+    """Класс CircuitBreaker - предохранитель одного внешнего API.
+    ------------------------------------------------------------
+    failures - сколько ошибок подряд (ошибка соединения, таймаут, ответ 5xx) переводят
+        предохранитель в состояние open: запросы к API не отправляются и сразу завершаются
+        ошибкой, а кэши отдают последние известные ответы, даже устаревшие.
+    cooldown - через сколько секунд после размыкания пропускается один пробный запрос
+        (состояние half_open). Его успех замыкает предохранитель, ошибка снова размыкает.
+    ------------------------------------------------------------
+    Методы
+        allow() - True, если запрос можно отправить. В состоянии half_open разрешает только
+            один пробный запрос (возвращает PROBE), остальные получают False, пока он
+            не завершится.
+        record(ok, probe) - записывает результат отправленного запроса; probe - это ответ
+            на пробный запрос (allow() вернул PROBE).
+        cancel(probe) - возвращает разрешение, полученное от allow(), если запрос так и не
+            отправлялся (например, не хватило квоты) или его результат ничего не говорит
+            о состоянии API.
+        is_open() - True, если предохранитель не замкнут (open или half_open): кэши в это время
+            отдают устаревшие ответы.
+        rejects() - True, если allow() сейчас откажет: предохранитель разомкнут и пробный
+            запрос еще рано отправлять или он уже отправлен. Разрешение при этом не берется,
+            поэтому так можно проверить API заранее, а запрос отправить позже.
+        retry_after() - через сколько секунд будет пробный запрос.
+        stats() - возвращает состояние и счетчики предохранителя."""
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self._failures = failures
+        self._cooldown = cooldown
+        self._state = CLOSED
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    def _update(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self._cooldown:
+            self._state = HALF_OPEN
+
+    def allow(self) -> bool:
+        with self._lock:
+            self._update()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return PROBE
+            self.rejected += 1
+            return False
+
+    def record(self, ok: bool, probe: bool = False):
+        with self._lock:
+            if probe:
+                self._probing = False
+            if ok:
+                self._state = CLOSED
+                self._consecutive = 0
+                return
+            self._consecutive += 1
+            if self._state == HALF_OPEN or self._consecutive >= self._failures:
+                if self._state != OPEN:
+                    self.opened += 1
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def cancel(self, probe: bool = False):
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def is_open(self) -> bool:
+        with self._lock:
+            self._update()
+            return self._state != CLOSED
+
+    def rejects(self) -> bool:
+        with self._lock:
+            self._update()
+            return self._state == OPEN or (self._state == HALF_OPEN and self._probing)
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._state == CLOSED:
+                return 0.0
+            return max(0.0, self._cooldown - (time.monotonic() - self._opened_at))
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._update()
+            return {'state': self._state, 'consecutive_failures': self._consecutive,
+                    'opened': self.opened, 'rejected': self.rejected}
@@ -0,0 +1,137 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """Класс LRUCache - потокобезопасный кэш в памяти с вытеснением давно неиспользуемых
+    записей и временем жизни записей.
+    ------------------------------------------------------------------------------------
+    maxsize - максимальное количество записей.
+    ttl - время жизни записи в секундах (None - записи не устаревают).
+    ------------------------------------------------------------------------------------
+    Методы
+        get(key, default) - возвращает значение по ключу или default, если его нет или оно
+            устарело.
+        get_stale(key, default) - возвращает значение по ключу, даже если оно устарело.
+            Устаревшие записи остаются в кэше, пока их не вытеснят новые, и выручают, когда
+            квота внешнего API на исходе.
+        set(key, value, ttl) - сохраняет значение, ttl переопределяет время жизни записи.
+        stats() - возвращает количество попаданий, промахов, долю попаданий и размер кэша."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            stored = self._data.get(key, MISSING)
+            if stored is not MISSING:
+                value, expires_at = stored
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def get_stale(self, key, default=None):
+        with self._lock:
+            stored = self._data.get(key, MISSING)
+            if stored is MISSING:
+                return default
+            self.stale_hits += 1
+            return stored[0]
+
+    def set(self, key, value, ttl: float = None):
+        ttl = ttl if ttl is not None else self._ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'stale_hits': self.stale_hits,
+            'size': len(self._data),
+        }
+
+
+class SqliteCache:
+    """Класс SqliteCache - постоянный кэш в файле SQLite, переживает перезапуск навыка.
+    Значения хранятся в JSON, поэтому должны сериализоваться в него.
+    -----------------------------------------------------------------------------------
+    path - путь к файлу базы данных.
+    ttl - время жизни записи в секундах.
+    -----------------------------------------------------------------------------------
+    Методы те же, что и у LRUCache."""
+
+    def __init__(self, path: str, ttl: float):
+        self._path = path
+        self._ttl = ttl
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._connection().execute('CREATE TABLE IF NOT EXISTS cache ('
+                                   'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                                   'expires_at REAL NOT NULL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str, default=None):
+        row = self._connection().execute('SELECT value FROM cache WHERE key = ? AND expires_at > ?',
+                                         (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(row[0])
+
+    def get_stale(self, key: str, default=None):
+        row = self._connection().execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        self.stale_hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float = None):
+        ttl = ttl if ttl is not None else self._ttl
+        self._connection().execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                                   (key, json.dumps(value, ensure_ascii=False), time.time() + ttl))
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'stale_hits': self.stale_hits,
+        }
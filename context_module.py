@@ -1,86 +1,221 @@
 import logging
 import os
-import re
 from abc import ABC, abstractmethod
 
-import requests
 from dotenv import load_dotenv
 
 from alice_module import *
 from conditions import CONDITIONS
+from deadline_module import (REQUEST_BUDGET, Deadline, ResultPending, current_deadline,
+                             run_concurrently, run_concurrently_async, run_in_background,
+                             run_in_background_async, run_with_deadline, run_with_deadline_async)
+from geocoder_module import GeocodingService, normalize_geo
+from images_module import ImageReaper, map_key
+from intent_module import EXIT, MAPS, SCANNER, THANKS, TRANSLATE, TRANSLATOR, WEATHER
+from languages_module import languages
+from metrics_module import metrics
+from prefetch_module import prefetcher
+from scanner_module import SCANNING, UrlScanner, find_links
+from singleflight_module import flights
+from translator_module import TranslationService
+from upstream_module import CircuitOpen, QuotaExhausted, UpstreamError, upstream
+from weather_module import Forecast, ForecastService
 
 env_path = os.path.join(os.path.dirname(__file__), '.env')
 load_dotenv(env_path)
-logging.basicConfig(
-    filename='logs.log',
-    format='%(asctime)s %(levelname)s %(name)s %(message)s',
-    level=logging.INFO
-)
-
-SCAN_WORDS = {'проверь', 'просканируй', 'сканируй', 'проверить', 'просканировать', 'сканировать',
-              'ссылка'}
-EXIT_WORDS = {'выход', 'пока', 'выйти', 'уйти', 'покинуть'}
-CHOICE_WORDS = {'функция', 'функции', 'возможности', 'возможность', 'варианты', 'вариант',
-                'модули', 'модуль', 'умеешь'}
-
-THANKS_WORDS = {'спасибо', 'класс', 'круто'}
-TRANSLATE_WORDS = {'переведи', 'переведите', 'перевод'}
 
 SKILL_ID = os.getenv('SKILL_ID')
 ACCESS_TOKEN = os.getenv('ACCESS_TOKEN')
 TRANSLATOR_TOKEN = os.getenv('TRANSLATOR_TOKEN')
 
-MAPS_URL = f'https://dialogs.yandex.net/api/v1/skills/{SKILL_ID}/images/'
+MAPS_PATH = f'/api/v1/skills/{SKILL_ID}/images/'
+MAP_SPN = '0.002,0.002'
+MAP_LAYERS = 'sat,skl'
 
 API_KEY = os.getenv('API_KEY')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
 GEOCODER_API_KEY = os.getenv('GEOCODER_API_KEY')
-VT_URL = 'https://www.virustotal.com/api/v3/urls'
+GEOCODER_CACHE_DB = os.getenv('GEOCODER_CACHE_DB')
+TRANSLATOR_CACHE_DB = os.getenv('TRANSLATOR_CACHE_DB')
+
+geocoder = GeocodingService(GEOCODER_API_KEY, db_path=GEOCODER_CACHE_DB)
+forecasts = ForecastService(WEATHER_API_KEY)
+scanner = UrlScanner(API_KEY)
+translator = TranslationService(TRANSLATOR_TOKEN, db_path=TRANSLATOR_CACHE_DB)
+images = ImageReaper(ACCESS_TOKEN, MAPS_PATH)
+metrics.register('caches', lambda: {'geocoder': geocoder.stats(), 'forecasts': forecasts.stats(),
+                                    'scanner': scanner.stats(), 'translator': translator.stats()})
+metrics.register('images', images.stats)
+metrics.register('prefetch', prefetcher.stats)
+
+PENDING_ANSWER = 'Еще выясняю, спроси меня еще раз через пару секунд.'
+PENDING_SUGGESTS = [{'title': 'Ну что там?', 'hide': True}, {'title': 'Выйти', 'hide': True}]
+QUOTA_ANSWER = 'Сейчас слишком много запросов, попробуй через минуту.'
+DAILY_QUOTA_ANSWER = 'На сегодня запросы к сервису закончились, попробуй завтра.'
+UNAVAILABLE_ANSWER = 'Сервис сейчас недоступен, попробуй через минуту.'
+STALE_NOTE = '\n(Сервис сейчас недоступен, данные могут быть устаревшими.)'
+# Сколько мест или ссылок из одной реплики обрабатывается (в галерее ItemsList до 5 картинок)
+MAX_ENTITIES = 5
+# Место кнопок-подсказок погоды и карт, его данные прогреваются заранее (см. ChoiceState)
+SUGGESTED_PLACE = normalize_geo({'city': 'москва'})
+
+
+def geo_places(req: AliceRequest) -> tuple:
+    """Возвращает нормализованные гео-объекты реплики без повторов, не больше MAX_ENTITIES."""
+    places = []
+    for geo in req.geo_names:
+        place = normalize_geo(geo)
+        if place and place not in places:
+            places.append(place)
+    return tuple(places[:MAX_ENTITIES])
+
+
+def stale_note(*names: str) -> str:
+    """Возвращает пометку для ответа, собранного из кэша, пока какое-то из API names
+    недоступно (его предохранитель разомкнут), иначе пустую строку."""
+    return STALE_NOTE if any(upstream.is_open(name) for name in names) else ''
+
+
+def merge_answers(titles: tuple, answers: list) -> str or bool:
+    """Склеивает ответы по нескольким местам или ссылкам в один, подписывая каждый. Ответы
+    с ошибкой пропускаются; если ответа нет ни одного, вызывает первую ошибку. Единственный
+    ответ возвращается как есть."""
+    parts = []
+    errors = []
+    for title, answer in zip(titles, answers):
+        if isinstance(answer, Exception):
+            errors.append(answer)
+        elif answer:
+            parts.append((title, answer))
+    if not parts:
+        if errors:
+            raise errors[0]
+        return False
+    if len(titles) == 1:
+        return parts[0][1]
+    return '\n\n'.join(f'{title}:\n{answer}' for title, answer in parts)
 
 
 class Context:
-    """Класс Context предназначен для управления состояниями навыка Алисы.
-    ---------------------------------------------------------------------
+    """Класс Context - запись сессии пользователя, по которой навык Алисы управляет состояниями.
+    ---------------------------------------------------------------------------------------
+    Состояния (State) - общие объекты без данных, по одному на класс. Все, что относится
+    к пользователю, хранится здесь, в __slots__ (без __dict__): текущее состояние и сущности -
+    входные данные запроса, ответ на который не успел подготовиться (места погоды и карт, текст
+    и языки перевода, ссылки, которые еще сканируются). Контекст сохраняется в общем хранилище
+    сессий, поэтому следующую реплику ("Ну что там?") может обработать любой процесс: он
+    продолжит задачу, если она выполняется в нем же (late_results - только локальный кэш
+    задач), или запустит ее заново по сущностям.
+    ---------------------------------------------------------------------------------------
     Методы
         transition_to(state) - переключает контекст в состояние state
 
-        handle_dialog(res, req) - основная функция для управления диалогом с пользователем.
+        handle_dialog(res, req, deadline) - основная функция для управления диалогом
+            с пользователем.
             res: AliceResponse - ответ для пользователя в виде класса AliceResponse
-            req: AliceRequest - запрос пользователя в виде класса AliceRequest"""
-    _state = None
-
-    def __init__(self, state):
-        self.transition_to(state)
+            req: AliceRequest - запрос пользователя в виде класса AliceRequest
+            deadline: Deadline - бюджет времени на запрос, по умолчанию REQUEST_BUDGET секунд
+
+        handle_dialog_async(res, req) - то же самое для асинхронного режима (async_main.py)
+
+        to_dict() - возвращает компактное описание контекста для хранилища сессий:
+            имя текущего состояния и сущности
+        from_dict(data) - восстанавливает контекст из описания, которое вернул to_dict()"""
+    __slots__ = ('state', 'entities')
+
+    def __init__(self, state, entities: tuple = ()):
+        self.state = state
+        self.entities = entities
+
+    def to_dict(self) -> dict:
+        data = {'s': type(self.state).__name__}
+        if self.entities:
+            data['e'] = list(self.entities)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        # Сессии, сохраненные до общих состояний, хранят ссылки в данных состояния,
+        # а совсем старые - одну ссылку строкой
+        entities = data.get('e') or data.get('d', {}).get('u') or ()
+        return cls(STATES[data['s']](),
+                   (entities,) if isinstance(entities, str) else tuple(entities))
 
     def transition_to(self, state):
-        logging.info(f'Context: переключаемся в {type(state).__name__}')
-        self._state = state
-        self._state.context = self
+        logging.info('Context: переключаемся в %s', type(state).__name__)
+        self.state = state
+        self.entities = ()
 
-    def handle_dialog(self, res: AliceResponse, req: AliceRequest):
-        self._state.handle_dialog(res, req)
+    def handle_dialog(self, res: AliceResponse, req: AliceRequest, deadline: Deadline = None):
+        deadline = deadline or Deadline(REQUEST_BUDGET)
+        token = current_deadline.set(deadline)
+        try:
+            with metrics.timer('state', type(self.state).__name__):
+                self.state.handle_dialog(self, res, req, deadline)
+        finally:
+            current_deadline.reset(token)
+
+    async def handle_dialog_async(self, res: AliceResponse, req: AliceRequest,
+                                  deadline: Deadline = None):
+        deadline = deadline or Deadline(REQUEST_BUDGET)
+        token = current_deadline.set(deadline)
+        try:
+            with metrics.timer('state', type(self.state).__name__):
+                await self.state.handle_dialog_async(self, res, req, deadline)
+        finally:
+            current_deadline.reset(token)
 
 
 class State(ABC):
     """Базовый абстрактный класс состояния.
+     --------------------------------------
+     Состояние не хранит данных: State() возвращает один общий объект на класс, а данные
+     пользователя приходят в методы вместе с его контекстом (context.entities).
      --------------------------------------
      Методы
-        context - возвращает используемый данным состоянием контекст
-        handle_dialog(res: req) - функция, которую вызывает контекст, для обработки диалога
-        с пользователем"""
-
-    @property
-    def context(self) -> Context:
-        return self._context
-
-    @context.setter
-    def context(self, context: Context) -> None:
-        self._context = context
+        handle_dialog(context, res: req, deadline) - функция, которую вызывает контекст, для
+        обработки диалога с пользователем. Запросы к внешним API нужно выполнять через
+        run_with_deadline, чтобы успеть ответить до истечения deadline
+        handle_dialog_async(context, res, req, deadline) - асинхронная версия handle_dialog.
+        По умолчанию вызывает handle_dialog, поэтому переопределять ее нужно только в состояниях,
+        которые ходят в сеть
+        set_pending_answer(res) - отвечает пользователю, что результат еще готовится
+        set_quota_answer(res, error) - отвечает пользователю, что квота внешнего API исчерпана
+        set_unavailable_answer(res) - отвечает пользователю, что внешний API недоступен
+            (разомкнут его предохранитель, а в кэше ответа нет)"""
+    __slots__ = ()
+    _instances = {}
+
+    def __new__(cls):
+        state = State._instances.get(cls)
+        if state is None:
+            state = State._instances[cls] = super().__new__(cls)
+        return state
 
     @abstractmethod
-    def handle_dialog(self, res: AliceResponse, req: AliceRequest):
+    def handle_dialog(self, context: Context, res: AliceResponse, req: AliceRequest,
+                      deadline: Deadline):
         pass
 
+    async def handle_dialog_async(self, context: Context, res: AliceResponse, req: AliceRequest,
+                                  deadline: Deadline):
+        self.handle_dialog(context, res, req, deadline)
+
+    @staticmethod
+    def set_pending_answer(res: AliceResponse):
+        res.set_answer(PENDING_ANSWER)
+        res.set_suggests(PENDING_SUGGESTS)
+
+    @staticmethod
+    def set_quota_answer(res: AliceResponse, error: QuotaExhausted):
+        res.set_answer(DAILY_QUOTA_ANSWER if error.retry_after > 60 * 60 else QUOTA_ANSWER)
+        res.set_suggests([{'title': 'Выйти', 'hide': True}])
+
+    @staticmethod
+    def set_unavailable_answer(res: AliceResponse):
+        res.set_answer(UNAVAILABLE_ANSWER)
+        res.set_suggests([{'title': 'Выйти', 'hide': True}])
+
 
 class ScanUrlState(State):
     """Класс ScanUrlState - одно из состояний навыка Алисы.
@@ -88,114 +223,124 @@ class ScanUrlState(State):
     Задача класса - реализовывать сканер ссылок.
     --------------------------------------------------------------------------------------------
     Методы
-        handle_dialog(res, req) - основная функция управления диалогом с пользователем
-        __delete_unnecessary_words(words) - удаляет из списка слов пользователя ненужные для
-            перевода слова.
-        __check_url_regex(url: str) - проверяет ссылку на соответствие стандартному формату ссылок.
-        __get_url_id(url: str) - возвращает id ссылки, необходимый для работы с API.
-        __get_info(url_id: str) - возвращает отчет по ссылке от разных антивирусов.
-        scan(self, url: str) - основной метод класса, включает в себя взаимодействие всех методов,
-            в итоге возвращает необходимый ответ пользователю.
+        handle_dialog(res, req, deadline) - основная функция управления диалогом с пользователем
+        __find_urls(req) - возвращает ссылки, которые нужно просканировать (не больше
+            MAX_ENTITIES), так, как их написал пользователь: в ответе они подписываются так же,
+            а канонический вид (ключ кэша и запроса к VirusTotal) получает scanner. Ссылки ищет
+            find_links за один проход по реплике.
+        __make_report(info: dict) - составляет ответ пользователю по отчету антивирусов.
+        __answer(res, urls, verdicts) - отвечает пользователю по вердиктам из scanner одним
+            сообщением. Ссылки, которые еще проверяются, запоминает, чтобы ответить
+            на следующей реплике.
+        handle_dialog_async - асинхронная версия handle_dialog.
     ---------------------------------------------------------------------------------------------"""
+    __slots__ = ()
 
-    def handle_dialog(self, res: AliceResponse, req: AliceRequest) -> None:
+    def handle_dialog(self, context: Context, res: AliceResponse, req: AliceRequest,
+                      deadline: Deadline) -> None:
+        if EXIT in req.intents:
+            context.transition_to(ChoiceState())
+            res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
+                           'Что хочешь попробовать?')
+            return
+        if THANKS in req.intents:
+            res.set_answer('Ага, не за что :)')
         try:
-            if set(req.words).intersection(EXIT_WORDS):
-                self.context.transition_to(ChoiceState())
-                res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
-                               'Что хочешь попробовать?')
-                return
-            if set(req.words).intersection(THANKS_WORDS):
-                res.set_answer('Ага, не за что :)')
-            if self.__check_url_regex(req.request_string):
-                result = self.scan(req.request_string)
-                if result:
-                    res.set_answer(result)
-                else:
-                    raise UserWarning
-            elif set(req.words).intersection(SCAN_WORDS):
-                cleaned_request = self.__delete_unnecessary_words(req.words)
-                if cleaned_request:
-                    result = self.scan(cleaned_request)
-                    logging.info(result)
-                    if result:
-                        res.set_answer(result)
-                    else:
-                        raise UserWarning
-                else:
-                    raise UserWarning
-            else:
-                raise UserWarning
+            urls = self.__find_urls(context, req)
         except UserWarning:
-            res.set_answer('Что-то не так, либо Вы не ввели ссылку, либо она неправильная. '
-                           'Попробуйте еще раз, либо поменяйте ссылку ;)')
-        res.set_suggests([{'title': 'Выйти', 'hide': True}])
-
-    def __delete_unnecessary_words(self, words: list) -> str or dict:
-        for e in words:
-            if self.__check_url_regex(e):
-                return e
+            urls = ()
+        try:
+            verdicts = [scanner.verdict(url) for url in urls]
+        except QuotaExhausted as e:
+            self.set_quota_answer(res, e)
+            return
+        except UpstreamError:
+            # VirusTotal недоступен или проверка сорвалась - это не вердикт ссылки
+            self.set_unavailable_answer(res)
+            return
+        self.__answer(context, res, urls, verdicts)
 
-    @staticmethod
-    def __check_url_regex(url: str) -> bool:
-        pattern = '^((http|https):\\/\\/)?(www\\.)?([A-Za-zА-Яа-я0-9]' \
-                  '{1}[A-Za-zА-Яа-я0-9\\-]*\\.?)*\\.{1}[A-Za-zА-Яа-я0-9-]' \
-                  '{2,8}(\\/([\\w#!:.?+=&%@!\\-\\/])*)?'
-        matches = re.match(pattern, url)
-        if matches:
-            return True
-        return False
+    async def handle_dialog_async(self, context: Context, res: AliceResponse, req: AliceRequest,
+                                  deadline: Deadline) -> None:
+        if EXIT in req.intents:
+            context.transition_to(ChoiceState())
+            res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
+                           'Что хочешь попробовать?')
+            return
+        if THANKS in req.intents:
+            res.set_answer('Ага, не за что :)')
+        try:
+            urls = self.__find_urls(context, req)
+        except UserWarning:
+            urls = ()
+        try:
+            verdicts = [await scanner.verdict_async(url) for url in urls]
+        except QuotaExhausted as e:
+            self.set_quota_answer(res, e)
+            return
+        except UpstreamError:
+            # VirusTotal недоступен или проверка сорвалась - это не вердикт ссылки
+            self.set_unavailable_answer(res)
+            return
+        self.__answer(context, res, urls, verdicts)
 
     @staticmethod
-    def __get_url_id(url: str) -> str or bool:
-        params = {'x-apikey': API_KEY}
-        req = requests.post(VT_URL, headers=params, data=f'url={url}')
-        if req.status_code == 200:
-            url_id = req.json()['data']['id']
-            return url_id
+    def __find_urls(context: Context, req: AliceRequest) -> tuple:
+        """Возвращает ссылки из запроса пользователя или ссылки, проверка которых не успела
+        завершиться на прошлой реплике. Если ссылок нет, вызывает UserWarning."""
+        urls = tuple(find_links(req.request_string, MAX_ENTITIES))
+        if urls:
+            return urls
+        if context.entities:
+            return context.entities
+        raise UserWarning
+
+    def __answer(self, context: Context, res: AliceResponse, urls: tuple, verdicts: list) -> None:
+        context.entities = tuple(url for url, verdict in zip(urls, verdicts)
+                                 if verdict is SCANNING)
+        ready = [(url, verdict) for url, verdict in zip(urls, verdicts) if verdict is not SCANNING]
+        if not ready and context.entities:
+            self.set_pending_answer(res)
+            return
+        logging.info('Scanner: %s', verdicts)
+        reports = [self.__make_report(verdict) if verdict else False for _, verdict in ready]
+        answer = merge_answers(tuple(url for url, _ in ready), reports) if ready else False
+        if answer and len(ready) == 1 and context.entities:
+            answer = f'{ready[0][0]}:\n{answer}'
+        if answer:
+            answer += stale_note('virustotal')
+        if not answer:
+            res.set_answer('Что-то не так, либо Вы не ввели ссылку, либо она неправильная. '
+                           'Попробуйте еще раз, либо поменяйте ссылку ;)')
+        elif context.entities:
+            res.set_answer(f'{answer}\n\nОстальные ссылки еще проверяю, спроси меня еще раз '
+                           'через пару секунд.')
+            res.set_suggests(PENDING_SUGGESTS)
+            return
+        else:
+            res.set_answer(answer)
+        res.set_suggests([{'title': 'Выйти', 'hide': True}])
 
     @staticmethod
-    def __get_info(url_id: str) -> dict or bool:
-        params = {'x-apikey': API_KEY}
-        response = requests.get(f'https://www.virustotal.com/api/v3/analyses/{url_id}',
-                                headers=params)
-        logging.info(response.json())
-        if response.status_code == 200:
-            res = dict(response.json()['data']['attributes']['results'])
-            results = dict()
-            for e in res.keys():
-                if res[e]['result'] in results.keys():
-                    results[res[e]['result']] += 1
-                else:
-                    results[res[e]['result']] = 1
-            logging.info(results)
-            return results
-        return False
-
-    def scan(self, url: str) -> str or bool:
-        url_id = self.__get_url_id(url)
-        if url_id:
-            info = self.__get_info(url_id)
-            if info:
-                comment = ''
-                if len(set(info.keys()).intersection({'clean', 'unrated'})) == 2:
-                    if info['unrated'] / info['clean'] >= 1.2:
-                        comment = 'Какая-то странная ссылка, будь внимателен\n'
-                    elif info['unrated'] / info['clean'] <= 0.1:
-                        comment = 'Все классно, должно быть безопасно!\n'
-                    else:
-                        comment = 'Что-то странное 0_o\n'
-                elif len(set(info.keys()).intersection({'clean', 'unrated'})) == 1:
-                    if 'clean' in info.keys():
-                        comment = 'Все классно, должно быть безопасно!\n'
-                    if 'unrated' in info.keys():
-                        comment = 'Что-то странное 0_o\n'
-                else:
-                    comment = 'Оу, братец, как-то подозрительно не думаю, что стоит переходить, ' \
-                              'либо используй защиту!\n'
-                report = f"Отчет антивирусов: {' '.join([f'{e} = {info[e]}' for e in info.keys()])}"
-                return comment + report
-        return False
+    def __make_report(info: dict) -> str:
+        comment = ''
+        if len(set(info.keys()).intersection({'clean', 'unrated'})) == 2:
+            if info['unrated'] / info['clean'] >= 1.2:
+                comment = 'Какая-то странная ссылка, будь внимателен\n'
+            elif info['unrated'] / info['clean'] <= 0.1:
+                comment = 'Все классно, должно быть безопасно!\n'
+            else:
+                comment = 'Что-то странное 0_o\n'
+        elif len(set(info.keys()).intersection({'clean', 'unrated'})) == 1:
+            if 'clean' in info.keys():
+                comment = 'Все классно, должно быть безопасно!\n'
+            if 'unrated' in info.keys():
+                comment = 'Что-то странное 0_o\n'
+        else:
+            comment = 'Оу, братец, как-то подозрительно не думаю, что стоит переходить, ' \
+                      'либо используй защиту!\n'
+        report = f"Отчет антивирусов: {' '.join([f'{e} = {info[e]}' for e in info.keys()])}"
+        return comment + report
 
 
 class TranslatorState(State):
@@ -216,7 +361,7 @@ class TranslatorState(State):
         определять стандартные ошибки при вводе пользователя
     --------------------------------------------------------------------------------------------
     Методы
-        handle_dialog(res, req) - основная функция управления диалогом с пользователем
+        handle_dialog(res, req, deadline) - основная функция управления диалогом с пользователем
         get_translate_request(words, foreign_words) - возвращает строку, которую необходимо
             перевести, исходный язык, язык перевода и callback (ошибку или OK)
         __delete_unnecessary_words(words) - удаляет из списка слов пользователя ненужные для
@@ -224,27 +369,78 @@ class TranslatorState(State):
         __get_languages(words) - определяет с какого языка и на какой язык пользователь хочет
             совершить перевод. Возвращает языки в формате ISO639-1. Если язык не поддерживается,
             возвращается None.Если языки не указаны, возвращает en, ru.
-        __language_to_iso(language) - возвращает язык в формате ISO639-1.
         __delete_languages(words, lang_fr, lang_to) - удаляет все языки ненужные из запроса
             для перевода
-        translate(text, language_from, language_to) - переводит текст (text) с языка
-            language_from на язык language_to
+        Языки и их формы ("с японского", "на японский язык") берутся из общей таблицы languages.
+        Сам перевод выполняет общий translator, который помнит уже сделанные переводы.
     ---------------------------------------------------------------------------------------------"""
+    __slots__ = ()
 
-    def handle_dialog(self, res: AliceResponse, req: AliceRequest):
-        if set(req.words).intersection(EXIT_WORDS):
-            self.context.transition_to(ChoiceState())
+    def handle_dialog(self, context: Context, res: AliceResponse, req: AliceRequest,
+                      deadline: Deadline):
+        if EXIT in req.intents:
+            context.transition_to(ChoiceState())
             res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
                            'Что хочешь попробовать?')
             return
 
-        if set(req.words).intersection(TRANSLATE_WORDS):
+        if TRANSLATE in req.intents:
             translate_req, lang_fr, lang_to, callback = self.get_translate_request(req.words,
                                                                                    req.foreign_words)
-            if callback == 'OK':
-                res.set_answer(self.translate(translate_req, lang_fr, lang_to))
+            if callback != 'OK':
+                res.set_answer(callback)
                 return
-            res.set_answer(callback)
+            context.entities = (translate_req, lang_fr, lang_to)
+        if context.entities:
+            key = ('translate', *context.entities)
+            context.entities = ()
+            try:
+                res.set_answer(run_with_deadline(req.user_id, key, translator.translate,
+                                                  *key[1:], deadline=deadline)
+                               + stale_note('translator'))
+            except ResultPending:
+                context.entities = key[1:]
+                self.set_pending_answer(res)
+            except QuotaExhausted as e:
+                self.set_quota_answer(res, e)
+            except UpstreamError:
+                res.set_answer('Переводчик сейчас недоступен, попробуйте чуть позже.')
+            return
+        res.set_answer('Пиши: переведи [слово/предложение] с [языка] на [язык].\n'
+                       'По умолчанию перевод производится с русского на английский\n'
+                       'Для более подробной помощи перейдите в раздел "Помощь"')
+        res.set_suggests([{'title': 'Выйти', 'hide': True}])
+
+    async def handle_dialog_async(self, context: Context, res: AliceResponse, req: AliceRequest,
+                                  deadline: Deadline):
+        if EXIT in req.intents:
+            context.transition_to(ChoiceState())
+            res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
+                           'Что хочешь попробовать?')
+            return
+
+        if TRANSLATE in req.intents:
+            translate_req, lang_fr, lang_to, callback = self.get_translate_request(req.words,
+                                                                                   req.foreign_words)
+            if callback != 'OK':
+                res.set_answer(callback)
+                return
+            context.entities = (translate_req, lang_fr, lang_to)
+        if context.entities:
+            key = ('translate', *context.entities)
+            context.entities = ()
+            try:
+                res.set_answer(await run_with_deadline_async(req.user_id, key,
+                                                             translator.translate_async,
+                                                             *key[1:], deadline=deadline)
+                               + stale_note('translator'))
+            except ResultPending:
+                context.entities = key[1:]
+                self.set_pending_answer(res)
+            except QuotaExhausted as e:
+                self.set_quota_answer(res, e)
+            except UpstreamError:
+                res.set_answer('Переводчик сейчас недоступен, попробуйте чуть позже.')
             return
         res.set_answer('Пиши: переведи [слово/предложение] с [языка] на [язык].\n'
                        'По умолчанию перевод производится с русского на английский\n'
@@ -280,68 +476,29 @@ class TranslatorState(State):
         to_translate_words = [word for word in words if word not in unnecessary_words]
         return to_translate_words
 
-    def __get_languages(self, words: list):
+    @staticmethod
+    def __get_languages(words: list):
         language_from = 'ru'
         language_to = 'en'
 
-        for i in range(len(words)):
-            if words[i] == 'с' and 'ского' in words[i + 1]:
-                language_from = self.__language_to_iso(f"{words[i + 1][:-3]}ий".title())
-            elif words[i] == 'на' and 'ский' in words[i + 1]:
-                language_to = self.__language_to_iso(words[i + 1].title())
+        for word, next_word in zip(words, words[1:]):
+            if word == 'с' and 'ского' in next_word:
+                language_from = languages.iso_from_genitive(next_word)
+            elif word == 'на' and 'ский' in next_word:
+                language_to = languages.iso(next_word)
 
         return language_from, language_to
 
-    @staticmethod
-    def __language_to_iso(language) -> str or None:
-        with open('languages.json', 'r') as json_file:
-            languages_to_iso = json.load(json_file)
-            try:
-                return languages_to_iso[language]
-            except KeyError:
-                return None
-
     @staticmethod
     def __delete_languages(words: list, lang_fr, lang_to) -> list:
-        with open('languages.json', 'r') as json_file:
-            langs = json.load(json_file)
-
-            fr_lang = [lang for lang, cd in langs.items() if cd == lang_fr][0][:-2].lower()
-            language_from = f'с {fr_lang}ого'
-            to_lang = [lang for lang, cd in langs.items() if cd == lang_to][0].lower()
-            language_to = f'на {to_lang}'
-
-            my_words = ' '.join(words)
-            if f'{language_from} языка' in my_words:
-                my_words = my_words.replace(f'{language_from} языка', '')
-            elif language_from in my_words:
-                my_words = my_words.replace(language_from, '')
-            if f'{language_to} язык' in my_words:
-                my_words = my_words.replace(f'{language_to} язык', '')
-            elif language_to in my_words:
-                my_words = my_words.replace(language_to, '')
+        my_words = ' '.join(words)
+        for phrases in (languages.get(lang_fr).from_phrases, languages.get(lang_to).to_phrases):
+            for phrase in phrases:
+                if phrase in my_words:
+                    my_words = my_words.replace(phrase, '')
+                    break
         return my_words.split()
 
-    @staticmethod
-    def translate(text, language_from='ru', language_to='en'):
-        url = "https://translated-mymemory---translation-memory.p.rapidapi.com/api/get"
-
-        params = {"langpair": f"{language_from}|{language_to}", "q": text, "mt": "1",
-                  "onlyprivate": "0"}
-
-        headers = {
-            'x-rapidapi-key': TRANSLATOR_TOKEN,
-            'x-rapidapi-host': "translated-mymemory---translation-memory.p.rapidapi.com"
-        }
-
-        response = requests.get(url, headers=headers, params=params)
-        logging.info(f'TranslatorRequest: {response.url}')
-
-        translated = response.json()['responseData']['translatedText']
-        if ''.join(translated.split()) == ''.join(text.split()):
-            return 'Вы указали неверный язык, перевод невозможен.'
-        return translated
-
 
 class WeatherState(State):
     """Класс WeatherState - одно из состояний навыка Алисы.
@@ -349,70 +506,141 @@ class WeatherState(State):
         Задача класса - реализовывать погодный информатор.
         --------------------------------------------------------------------------------------------
         Методы
-            handle_dialog(res, req) - основная функция управления диалогом с пользователем
-            __string_for_geocoder(place_dict: dict) - возвращает очищенный гео-запрос, необходимый
-                для определения координат места, в котором надо узнать погоду.
-            __get_coord(place: str) - возвращает словарь координат места.
-            __get_info(self, req: AliceRequest) - основной метод класса, включает в себя
-                взаимодействие всех методов. В итоге возвращает необходимый ответ пользователю.
+            handle_dialog(res, req, deadline) - основная функция управления диалогом с пользователем
+            __get_places(req: AliceRequest) - возвращает нормализованные гео-запросы мест,
+                в которых надо узнать погоду. Координаты мест ищет общий geocoder.
+            __format_weather(forecast: Forecast) - составляет ответ пользователю по прогнозу.
+                Прогнозы берутся из общего кэша forecasts.
+            __get_info(self, places: tuple) - основной метод класса, включает в себя
+                взаимодействие всех методов. Прогнозы для всех мест запрашиваются параллельно
+                и склеиваются в один ответ пользователю.
+            prefetch(place) - заранее получает координаты и прогноз места (для Prefetcher).
+            handle_dialog_async, __get_info_async, prefetch_async - асинхронные версии методов.
         -----------------------------------------------------------------------------------------"""
+    __slots__ = ()
 
-    def handle_dialog(self, res: AliceResponse, req: AliceRequest):
+    def handle_dialog(self, context: Context, res: AliceResponse, req: AliceRequest,
+                      deadline: Deadline):
         try:
-            if set(req.words).intersection(EXIT_WORDS):
-                self.context.transition_to(ChoiceState())
+            if EXIT in req.intents:
+                context.transition_to(ChoiceState())
                 res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
                                'Что хочешь попробовать?')
                 return
-            if set(req.words).intersection(THANKS_WORDS):
+            if THANKS in req.intents:
                 res.set_answer('Ага, не за что :)')
             else:
-                weather = self.__get_info(req)
+                places = self.__get_places(context, req)
+                context.entities = ()
+                weather = run_with_deadline(req.user_id, ('weather', places), self.__get_info,
+                                            places, deadline=deadline)
                 if weather:
-                    res.set_answer(weather)
+                    res.set_answer(weather + stale_note('geocoder', 'weather'))
                 else:
                     raise UserWarning
-        except UserWarning:
+        except ResultPending:
+            context.entities = places
+            self.set_pending_answer(res)
+            return
+        except QuotaExhausted as e:
+            self.set_quota_answer(res, e)
+            return
+        except CircuitOpen:
+            self.set_unavailable_answer(res)
+            return
+        except (UserWarning, UpstreamError):
+            res.set_answer('0_o Что-то вы делаете не так, либо пробуйте еще, либо измените ваш запрос.')
+        res.set_suggests([{'title': 'Выйти', 'hide': True}])
+
+    async def handle_dialog_async(self, context: Context, res: AliceResponse, req: AliceRequest,
+                                  deadline: Deadline):
+        try:
+            if EXIT in req.intents:
+                context.transition_to(ChoiceState())
+                res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
+                               'Что хочешь попробовать?')
+                return
+            if THANKS in req.intents:
+                res.set_answer('Ага, не за что :)')
+            else:
+                places = self.__get_places(context, req)
+                context.entities = ()
+                weather = await run_with_deadline_async(req.user_id, ('weather', places),
+                                                        self.__get_info_async, places,
+                                                        deadline=deadline)
+                if weather:
+                    res.set_answer(weather + stale_note('geocoder', 'weather'))
+                else:
+                    raise UserWarning
+        except ResultPending:
+            context.entities = places
+            self.set_pending_answer(res)
+            return
+        except QuotaExhausted as e:
+            self.set_quota_answer(res, e)
+            return
+        except CircuitOpen:
+            self.set_unavailable_answer(res)
+            return
+        except (UserWarning, UpstreamError):
             res.set_answer('0_o Что-то вы делаете не так, либо пробуйте еще, либо измените ваш запрос.')
         res.set_suggests([{'title': 'Выйти', 'hide': True}])
 
     @staticmethod
-    def __string_for_geocoder(place_dict: dict) -> str or bool:
-        if len(place_dict.keys()):
-            return ' '.join([place_dict[key] for key in place_dict.keys()])
-        return False
+    def __get_places(context: Context, req: AliceRequest) -> tuple:
+        """Возвращает места из запроса пользователя или места, прогноз для которых не успел
+        подготовиться на прошлой реплике (context.entities). Если мест нет, вызывает
+        UserWarning."""
+        places = geo_places(req)
+        if places:
+            for place in places:
+                prefetcher.hit(('weather', place))
+            return places
+        if context.entities:
+            return context.entities
+        raise UserWarning
 
     @staticmethod
-    def __get_coord(place: str) -> dict or bool:
-        r = requests.get(
-            f'https://geocode-maps.yandex.ru/1.x/?format=json&apikey={GEOCODER_API_KEY}'
-            f'&geocode={place}')
-        if r.status_code == 200:
-            json_data = r.json()
-            toponym = json_data['response']['GeoObjectCollection']['featureMember'][0]
-            coord = toponym['GeoObject']['Point']['pos'].split()
-            return {'lat': coord[1], 'lon': coord[0]}
+    def __format_weather(forecast: Forecast) -> str:
+        cond = CONDITIONS[forecast.condition]
+        return f'СЕГОДНЯ:\n Температура: {forecast.temp}°C, ощущается как {forecast.feels_like}°C;' \
+               f' \nУсловия: {cond}, ' \
+               f'\nВетер: {forecast.wind_speed} м/с;\nЗАВТРА: \nТемпература: {forecast.yesterday_temp}°C'
+
+    def __get_info(self, places: tuple) -> str or bool:
+        return merge_answers(self.__titles(places),
+                             run_concurrently(self.__get_place_info, places))
+
+    async def __get_info_async(self, places: tuple) -> str or bool:
+        return merge_answers(self.__titles(places),
+                             await run_concurrently_async(self.__get_place_info_async, places))
+
+    @staticmethod
+    def __titles(places: tuple) -> tuple:
+        return tuple(place.capitalize() for place in places)
+
+    def prefetch(self, place: str):
+        self.__get_place_info(place)
+
+    async def prefetch_async(self, place: str):
+        await self.__get_place_info_async(place)
+
+    def __get_place_info(self, place: str) -> str or bool:
+        coord = geocoder.lookup(place)
+        if coord:
+            lon, lat = coord
+            forecast = forecasts.get(lat, lon)
+            if forecast:
+                return self.__format_weather(forecast)
         return False
 
-    def __get_info(self, req: AliceRequest) -> dict or bool:
-        if req.geo_names:
-            place_req = self.__string_for_geocoder(req.geo_names[0])
-            coord = self.__get_coord(place_req)
-            if coord:
-                params = {'X-Yandex-API-Key': WEATHER_API_KEY}
-                lat = coord['lat']
-                lon = coord['lon']
-                url = f'https://api.weather.yandex.ru/v2/forecast?lat={lat}&lon={lon}&extra=true'
-                req = requests.get(url, headers=params)
-                if req.status_code == 200:
-                    now_temp = req.json()['fact']['temp']
-                    feels_like = req.json()['fact']['feels_like']
-                    cond = CONDITIONS[req.json()['fact']['condition']]
-                    wind = req.json()['fact']['wind_speed']
-                    yesterday = req.json()['yesterday']['temp']
-                    return f'СЕГОДНЯ:\n Температура: {now_temp}°C, ощущается как {feels_like}°C;' \
-                           f' \nУсловия: {cond}, ' \
-                           f'\nВетер: {wind} м/с;\nЗАВТРА: \nТемпература: {yesterday}°C'
+    async def __get_place_info_async(self, place: str) -> str or bool:
+        coord = await geocoder.lookup_async(place)
+        if coord:
+            lon, lat = coord
+            forecast = await forecasts.get_async(lat, lon)
+            if forecast:
+                return self.__format_weather(forecast)
         return False
 
 
@@ -420,51 +648,147 @@ class MapsState(State):
     """Класс MapsState - одно из состояний навыка для Алисы для взаимодействия с API Яндекс.Карт
     ---------------------------------------------------------------------------------------------
     Note:
-        На карте показывается первый введеный пользователем адрес
+        Если пользователь назвал несколько адресов, их карты показываются галереей ItemsList
     ----------------------------------------------------------------------------------------------
     Основная задача состояния - показывать на карте адрес, который ввел пользователь
     ---------------------------------------------------------------------------------------------
     Методы:
-        handle_dialog(res, req) - основная функция для взаимодействия с пользователем.
-        get_image(geo_name) - возвращает image_id загруженной картинки Яндекс.Карт.
-        delete_user_requests(ignore_id) - удаляет предыдущие картинки пользователей из памяти навыка.
-        __get_all_images() - возвращает список всех изображений в памяти навыка.
-        __get_place_coordinates() - возвращает координаты места, введеного текстом.
-        __get_place_image() - возвращает фотографию места по координатам.
+        handle_dialog(res, req, deadline) - основная функция для взаимодействия с пользователем.
+        get_images(places) - получает карты всех мест параллельно и возвращает
+            [(место, image_id)] для найденных.
+        get_image(geo_name) - возвращает image_id загруженной картинки Яндекс.Карт. Карта места,
+            которое уже показывали, берется из кэша images без запросов к API.
+        __get_place_coordinates() - возвращает координаты места, введеного текстом, через общий
+            geocoder.
+        __get_place_image() - возвращает фотографию места по ключу map_key.
         __upload_to_resources() - загружает фотографию места в память навыка и вовзращает id.
+        Методы с суффиксом _async - асинхронные версии соответствующих методов.
+    Прежние картинки пользователя удаляет в фоне общий images (ImageReaper): картинки других
+    пользователей не трогаются.
     ------------------------------------------------------------------------------------------------
     """
+    __slots__ = ()
+
+    def handle_dialog(self, context: Context, res: AliceResponse, req: AliceRequest,
+                      deadline: Deadline):
+        places = geo_places(req)
+        for place in places:
+            prefetcher.hit(('maps', place))
+        places = places or context.entities
+        context.entities = ()
+        if places:
+            try:
+                found = run_with_deadline(req.user_id, ('maps', places), self.get_images, places,
+                                          deadline=deadline)
+            except ResultPending:
+                context.entities = places
+                self.set_pending_answer(res)
+                return
+            except QuotaExhausted as e:
+                self.set_quota_answer(res, e)
+                return
+            except CircuitOpen:
+                self.set_unavailable_answer(res)
+                return
+            except UpstreamError:
+                found = []
+            if found:
+                res.set_image(self.__make_card(found))
+                run_in_background(images.delete,
+                                  images.track(req.user_id, [image_id for _, image_id in found]))
+            else:
+                res.set_answer('Произошла ошибка')
+        if EXIT in req.intents:
+            run_in_background(images.delete, images.release(req.user_id))
+            context.transition_to(ChoiceState())
+            res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
+                           'Что хочешь попробовать?')
+            return
+        res.set_answer('Введи любое место и я тебе его покажу на карте!')
 
-    def handle_dialog(self, res: AliceResponse, req: AliceRequest):
-        if req.geo_names:
-            image = {
-                'type': "BigImage",
-                'image_id': None,
-                'title': 'Вот это место на карте',
-            }
-
-            geo_name = ' '.join(val for key, val in req.geo_names[0].items())
-            image_id, callback = self.get_image(geo_name)
-            if callback == 'OK':
-                image['image_id'] = image_id
-                res.set_image(image)
-                self.delete_user_requests(image_id)
+    async def handle_dialog_async(self, context: Context, res: AliceResponse, req: AliceRequest,
+                                  deadline: Deadline):
+        places = geo_places(req)
+        for place in places:
+            prefetcher.hit(('maps', place))
+        places = places or context.entities
+        context.entities = ()
+        if places:
+            try:
+                found = await run_with_deadline_async(req.user_id, ('maps', places),
+                                                      self.get_images_async, places,
+                                                      deadline=deadline)
+            except ResultPending:
+                context.entities = places
+                self.set_pending_answer(res)
+                return
+            except QuotaExhausted as e:
+                self.set_quota_answer(res, e)
+                return
+            except CircuitOpen:
+                self.set_unavailable_answer(res)
+                return
+            except UpstreamError:
+                found = []
+            if found:
+                res.set_image(self.__make_card(found))
+                run_in_background_async(images.delete_async,
+                                        images.track(req.user_id, [image_id for _, image_id in found]))
             else:
                 res.set_answer('Произошла ошибка')
-        if set(req.words).intersection(EXIT_WORDS):
-            self.delete_user_requests()
-            self.context.transition_to(ChoiceState())
+        if EXIT in req.intents:
+            run_in_background_async(images.delete_async, images.release(req.user_id))
+            context.transition_to(ChoiceState())
             res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
                            'Что хочешь попробовать?')
             return
         res.set_answer('Введи любое место и я тебе его покажу на карте!')
 
+    def get_images(self, places: tuple) -> list:
+        return self.__found(places, run_concurrently(self.get_image, places))
+
+    async def get_images_async(self, places: tuple) -> list:
+        return self.__found(places, await run_concurrently_async(self.get_image_async, places))
+
+    @staticmethod
+    def __found(places: tuple, results: list) -> list:
+        """Возвращает [(место, image_id)] для мест, карты которых удалось получить. Если не
+        удалось ни одной, а какой-то запрос завершился ошибкой, вызывает первую ошибку."""
+        found = []
+        errors = []
+        for place, result in zip(places, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+            elif result[1] == 'OK':
+                found.append((place, result[0]))
+        if not found and errors:
+            raise errors[0]
+        return found
+
+    @staticmethod
+    def __make_card(found: list) -> dict:
+        if len(found) == 1:
+            return {'type': 'BigImage', 'image_id': found[0][1], 'title': 'Вот это место на карте'}
+        return {
+            'type': 'ItemsList',
+            'header': {'text': 'Вот эти места на карте'},
+            'items': [{'image_id': image_id, 'title': place.capitalize()[:128]}
+                      for place, image_id in found],
+        }
+
     def get_image(self, geo_name):
         coordinates, callback = self.__get_place_coordinates(geo_name)
         if callback == 'Error':
             return None, 'Error'
 
-        image_url, callback = self.__get_place_image(coordinates)
+        key = map_key(*coordinates, MAP_SPN, MAP_LAYERS)
+        image_id = images.lookup(key)
+        if image_id:
+            return image_id, 'OK'
+        return flights.do(('static_maps', key), self.__load_image, key)
+
+    def __load_image(self, key):
+        image_url, callback = self.__get_place_image(key)
         if callback == 'Error':
             return None, 'Error'
 
@@ -472,53 +796,64 @@ class MapsState(State):
         if callback == 'Error':
             return None, 'Error'
 
+        run_in_background(images.delete, images.remember(key, image_id))
         return image_id, 'OK'
 
-    def delete_user_requests(self, ignore_id=None):
-        headers = {'Authorization': f'OAuth {ACCESS_TOKEN}'}
-        for image in self.__get_all_images():
-            if image['id'] != ignore_id:
-                requests.delete(f'{MAPS_URL}{image["id"]}', headers=headers)
-        logging.info(f'MapsRequestToSkill: Deleting all images. Exception: {ignore_id}')
+    async def get_image_async(self, geo_name):
+        coordinates, callback = await self.__get_place_coordinates_async(geo_name)
+        if callback == 'Error':
+            return None, 'Error'
 
-    @staticmethod
-    def __get_all_images():
+        key = map_key(*coordinates, MAP_SPN, MAP_LAYERS)
+        image_id = images.lookup(key)
+        if image_id:
+            return image_id, 'OK'
+        return await flights.do_async(('static_maps', key), self.__load_image_async, key)
 
-        headers = {'Authorization': F'OAuth {ACCESS_TOKEN}'}
+    async def __load_image_async(self, key):
+        image_url, callback = await self.__get_place_image_async(key)
+        if callback == 'Error':
+            return None, 'Error'
 
-        response = requests.get(MAPS_URL, headers=headers)
-        logging.info('MapsRequestToSkill: Getting all images')
-        if response:
-            return response.json()['images']
+        image_id, callback = await self.__upload_to_resources_async(image_url)
+        if callback == 'Error':
+            return None, 'Error'
+
+        run_in_background_async(images.delete_async, images.remember(key, image_id))
+        return image_id, 'OK'
 
     @staticmethod
     def __get_place_coordinates(geo_name):
-        geocode_request = 'https://geocode-maps.yandex.ru/1.x/'
-        geocode_params = {
-            'apikey': GEOCODER_API_KEY,
-            'geocode': geo_name,
-            'format': 'json'
-        }
+        coordinates = geocoder.lookup(geo_name)
+        if coordinates:
+            return coordinates, 'OK'
+        return None, 'Error'
 
-        response = requests.get(geocode_request, params=geocode_params)
-        logging.info(f'MapsRequestToGeocoder: {response.url}')
-        if response:
-            json_response = response.json()
-            toponym = json_response["response"]["GeoObjectCollection"]["featureMember"][0]
-            coordinates = toponym["GeoObject"]['Point']['pos']
+    @staticmethod
+    async def __get_place_coordinates_async(geo_name):
+        coordinates = await geocoder.lookup_async(geo_name)
+        if coordinates:
             return coordinates, 'OK'
         return None, 'Error'
 
     @staticmethod
-    def __get_place_image(coordinates):
-        map_request = "http://static-maps.yandex.ru/1.x/"
-        map_params = {
-            'll': ','.join(coordinates.split()),
-            'spn': '0.002,0.002',
-            'l': 'sat,skl'}
-
-        response = requests.get(map_request, params=map_params)
-        logging.info(f'MapsRequestToStatic: {response.url}')
+    def __get_place_image(key):
+        lon, lat, spn, layers = key
+        map_params = {'ll': f'{lon},{lat}', 'spn': spn, 'l': layers}
+
+        response = upstream.get('static_maps', '/1.x/', params=map_params)
+        logging.info('MapsRequestToStatic: %s', response.url)
+        if response:
+            return response.url, 'OK'
+        return None, 'Error'
+
+    @staticmethod
+    async def __get_place_image_async(key):
+        lon, lat, spn, layers = key
+        map_params = {'ll': f'{lon},{lat}', 'spn': spn, 'l': layers}
+
+        response = await upstream.get_async('static_maps', '/1.x/', params=map_params)
+        logging.info('MapsRequestToStatic: %s', response.url)
         if response:
             return response.url, 'OK'
         return None, 'Error'
@@ -531,8 +866,25 @@ class MapsState(State):
         }
 
         json_req = {'url': image}
-        response = requests.post(MAPS_URL, headers=headers, json=json_req)
-        logging.info(f'MapsRequestToUpload: {image}')
+        response = upstream.post('dialogs', MAPS_PATH, headers=headers, json=json_req)
+        logging.info('MapsRequestToUpload: %s', image)
+        if response:
+            json_response = response.json()
+            image_id = json_response['image']['id']
+            return image_id, 'OK'
+
+        return None, 'Error'
+
+    @staticmethod
+    async def __upload_to_resources_async(image):
+        headers = {
+            'Authorization': f'OAuth {ACCESS_TOKEN}',
+            'Content-Type': 'application/json'
+        }
+
+        json_req = {'url': image}
+        response = await upstream.post_async('dialogs', MAPS_PATH, headers=headers, json=json_req)
+        logging.info('MapsRequestToUpload: %s', image)
         if response:
             json_response = response.json()
             image_id = json_response['image']['id']
@@ -542,37 +894,74 @@ class MapsState(State):
 
 
 class HelloState(State):
-    def handle_dialog(self, res: AliceResponse, req: AliceRequest):
+    __slots__ = ()
+
+    def handle_dialog(self, context: Context, res: AliceResponse, req: AliceRequest,
+                      deadline: Deadline):
         res.set_answer('Привет. Меня зовут Алиса.\nА это новый мультинавык от разрабов k!dd0 и R1fl3')
-        self.context.transition_to(ChoiceState())
+        context.transition_to(ChoiceState())
 
 
 class ChoiceState(State):
-    def handle_dialog(self, res: AliceResponse, req: AliceRequest):
-        if set(req.words).intersection(EXIT_WORDS):
+    """Класс ChoiceState - выбор функции навыка.
+    --------------------------------------------
+    При переходе в погоду или карты заранее прогревает в фоне данные места кнопки-подсказки
+    и соединения с API, которые понадобятся на следующей реплике (см. Prefetcher)."""
+    __slots__ = ()
+
+    def handle_dialog(self, context: Context, res: AliceResponse, req: AliceRequest,
+                      deadline: Deadline):
+        self.__prefetch(self.__route(context, res, req), asynchronous=False)
+
+    async def handle_dialog_async(self, context: Context, res: AliceResponse, req: AliceRequest,
+                                  deadline: Deadline):
+        self.__prefetch(self.__route(context, res, req), asynchronous=True)
+
+    @staticmethod
+    def __prefetch(state, asynchronous: bool):
+        if isinstance(state, WeatherState):
+            prefetcher.prefetch(('weather', SUGGESTED_PLACE),
+                                state.prefetch_async if asynchronous else state.prefetch,
+                                SUGGESTED_PLACE, upstreams=('geocoder', 'weather'))
+            prefetcher.warm(('geocoder', 'weather'), asynchronous)
+        elif isinstance(state, MapsState):
+            prefetcher.prefetch(('maps', SUGGESTED_PLACE),
+                                state.get_image_async if asynchronous else state.get_image,
+                                SUGGESTED_PLACE, upstreams=('geocoder', 'static_maps', 'dialogs'))
+            prefetcher.warm(('geocoder', 'static_maps', 'dialogs'), asynchronous)
+
+    @staticmethod
+    def __route(context: Context, res: AliceResponse, req: AliceRequest) -> State or None:
+        """Отвечает пользователю и переключает навык в выбранное состояние, возвращает его."""
+        if EXIT in req.intents:
             res.set_answer('Пока!')
             res.end_session()
-            return
-        if 'переводчик' in req.words:
-            self.context.transition_to(TranslatorState())
+            return None
+        if TRANSLATOR in req.intents:
+            state = TranslatorState()
             res.set_answer('Хорошо, давай переводить!\n'
                            'Пиши: переведи [слово]')
-            return
-        if 'сканер' in req.words:
-            self.context.transition_to(ScanUrlState())
+        elif SCANNER in req.intents:
+            state = ScanUrlState()
             res.set_answer('Хорошо, отправь ссылку на сканирование!\n'
                            'Пиши: [url] или ссылка: [url]')
-            return
-        if 'погода' in req.words or 'погоду' in req.words:
-            self.context.transition_to(WeatherState())
+        elif WEATHER in req.intents:
+            state = WeatherState()
             res.set_answer('Хорошо, пиши место, где надо узнать погоду!\n'
                            'Пиши: [место]')
             res.set_suggests([{'title': 'Погода в Москве', 'hide': True}])
-            return
-        if 'карты' in req.words:
-            self.context.transition_to(MapsState())
+        elif MAPS in req.intents:
+            state = MapsState()
             res.set_answer('Введи любое место и я тебе его покажу на карте!')
-            return
-        res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
-                       'Что хочешь попробовать?')
-        res.set_suggests([{'title': 'Выйти', 'hide': True}])
+            res.set_suggests([{'title': 'Москва', 'hide': True}])
+        else:
+            res.set_answer('У нас есть несколько функций: переводчик, сканер, погода и карты.\n'
+                           'Что хочешь попробовать?')
+            res.set_suggests([{'title': 'Выйти', 'hide': True}])
+            return None
+        context.transition_to(state)
+        return state
+
+
+STATES = {state.__name__: state for state in (HelloState, ChoiceState, ScanUrlState,
+                                              TranslatorState, WeatherState, MapsState)}
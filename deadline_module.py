@@ -0,0 +1,187 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# Алиса ждет ответ вебхука около 3 секунд, часть этого времени уходит на сеть до навыка.
+REQUEST_BUDGET = float(os.getenv('REQUEST_BUDGET', 2.5))
+# Сколько времени фоновая задача может продолжать работу после того, как пользователю
+# уже ответили "проверяю, спроси еще раз".
+JOB_BUDGET = float(os.getenv('JOB_BUDGET', 10.0))
+LATE_RESULT_TTL = 60
+
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class ResultPending(Exception):
+    """Результат не успел подготовиться за отведенное запросу время. Задача продолжает
+    выполняться, ее результат будет отдан на следующей реплике пользователя."""
+
+
+class Deadline:
+    """Класс Deadline - бюджет времени на обработку одного запроса.
+    ----------------------------------------------------------------
+    Методы
+        remaining() - сколько секунд осталось до истечения бюджета.
+        expired - True, если бюджет исчерпан.
+        clamp(timeout) - уменьшает таймаут (или кортеж таймаутов) до оставшегося времени."""
+
+    def __init__(self, budget: float):
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    def clamp(self, timeout):
+        remaining = self.remaining()
+        if isinstance(timeout, tuple):
+            return tuple(min(t, remaining) for t in timeout)
+        return min(timeout, remaining)
+
+
+class LateResults:
+    """Класс LateResults хранит задачи, которые не успели выполниться за время запроса.
+    ------------------------------------------------------------------------------------
+    У каждого пользователя хранится не больше одной задачи - последняя. Задачи старше ttl
+    секунд выбрасываются. Это локальный кэш процесса: входные данные задачи хранятся в сессии
+    пользователя (Context.entities), и если следующая реплика попала в другой процесс, задача
+    просто запускается заново.
+    ------------------------------------------------------------------------------------
+    Методы
+        put(user_id, key, job) - сохраняет незавершенную задачу пользователя.
+        take(user_id, key) - забирает задачу пользователя с ключом key или возвращает None."""
+
+    def __init__(self, ttl: float = LATE_RESULT_TTL):
+        self._ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._jobs:
+            user_id, (key, job, stored_at) = next(iter(self._jobs.items()))
+            if now - stored_at < self._ttl:
+                break
+            del self._jobs[user_id]
+
+    def put(self, user_id, key, job):
+        with self._lock:
+            self._jobs.pop(user_id, None)
+            self._jobs[user_id] = (key, job, time.monotonic())
+            self._evict()
+
+    def take(self, user_id, key):
+        with self._lock:
+            self._evict()
+            stored = self._jobs.get(user_id)
+            if stored is None or stored[0] != key:
+                return None
+            del self._jobs[user_id]
+            return stored[1]
+
+
+late_results = LateResults()
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('JOB_WORKERS', 32)),
+                               thread_name_prefix='job')
+# Отдельный пул для run_concurrently: его вызывают задачи из _executor, и если бы они ждали
+# подзадачи в том же пуле, при полной загрузке пул заблокировал бы сам себя.
+_fanout_executor = ThreadPoolExecutor(max_workers=int(os.getenv('FANOUT_WORKERS', 32)),
+                                      thread_name_prefix='fanout')
+# Фоновые задачи (упреждающие запросы, удаление картинок) выполняются в своем небольшом пуле:
+# они могут подолгу ждать квоты и не должны занимать потоки, которые ждут реплики пользователей.
+_background_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BACKGROUND_WORKERS', 4)),
+                                          thread_name_prefix='background')
+
+
+def _run_job(fn, args):
+    current_deadline.set(Deadline(JOB_BUDGET))
+    return fn(*args)
+
+
+async def _run_job_async(fn, args):
+    current_deadline.set(Deadline(JOB_BUDGET))
+    return await fn(*args)
+
+
+_background_tasks = set()
+
+
+def _log_failure(job):
+    if not job.cancelled() and job.exception() is not None:
+        logging.error('BackgroundJob: %r', job.exception())
+
+
+def run_in_background(fn, *args, executor: ThreadPoolExecutor = None):
+    """Запускает fn в фоне, не дожидаясь результата. Фоновые задачи видят contextvars
+    вызывающего кода, например трассировку реплики. Задачи выполняются в пуле executor,
+    по умолчанию - в общем пуле фоновых задач, а не в пуле run_with_deadline."""
+    executor = executor or _background_executor
+    job = executor.submit(contextvars.copy_context().run, _run_job, fn, args)
+    job.add_done_callback(_log_failure)
+    return job
+
+
+def run_in_background_async(fn, *args):
+    """Асинхронная версия run_in_background, fn - корутинная функция."""
+    task = asyncio.ensure_future(_run_job_async(fn, args))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_failure)
+    return task
+
+
+def run_concurrently(fn, items) -> list:
+    """Вызывает fn(item) для всех items параллельно и возвращает результаты в том же порядке.
+    Вместо результата вызова, завершившегося ошибкой, в списке будет исключение. Вызовы видят
+    contextvars вызывающего кода, в том числе его бюджет времени current_deadline."""
+    jobs = [_fanout_executor.submit(contextvars.copy_context().run, fn, item)
+            for item in items[1:]]
+    results = []
+    # Первый вызов выполняется в этом же потоке, пока остальные ждут в пуле
+    try:
+        results.append(fn(items[0]))
+    except Exception as e:
+        results.append(e)
+    for job in jobs:
+        try:
+            results.append(job.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+async def run_concurrently_async(fn, items) -> list:
+    """Асинхронная версия run_concurrently, fn - корутинная функция."""
+    return list(await asyncio.gather(*[fn(item) for item in items], return_exceptions=True))
+
+
+def run_with_deadline(user_id, key, fn, *args, deadline: Deadline):
+    """Выполняет fn(*args) в фоновом потоке и ждет результат не дольше, чем позволяет deadline.
+    Если пользователь уже запускал задачу с таким же ключом, вместо новой ждет ее.
+    Если результат не успел подготовиться, сохраняет задачу в late_results и вызывает
+    ResultPending."""
+    job = late_results.take(user_id, key) or _executor.submit(contextvars.copy_context().run,
+                                                              _run_job, fn, args)
+    try:
+        return job.result(timeout=deadline.remaining())
+    except TimeoutError:
+        late_results.put(user_id, key, job)
+        raise ResultPending
+
+
+async def run_with_deadline_async(user_id, key, fn, *args, deadline: Deadline):
+    """Асинхронная версия run_with_deadline, fn - корутинная функция."""
+    job = late_results.take(user_id, key) or asyncio.ensure_future(_run_job_async(fn, args))
+    try:
+        return await asyncio.wait_for(asyncio.shield(job), deadline.remaining())
+    except asyncio.TimeoutError:
+        late_results.put(user_id, key, job)
+        raise ResultPending
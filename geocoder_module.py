@@ -0,0 +1,109 @@
+import logging
+import threading
+
+from cache_module import MISSING, LRUCache, SqliteCache
+from singleflight_module import flights
+from upstream_module import upstream
+
+GEOCODER_TTL = 30 * 24 * 60 * 60
+# Порядок частей адреса в запросе к геокодеру, остальные части идут после них
+GEO_FIELDS = ('country', 'city', 'street', 'house_number', 'airport')
+
+
+def normalize_geo(geo: dict) -> str:
+    """Возвращает нормализованную строку гео-объекта Алисы (элемента AliceRequest.geo_names):
+    части адреса в постоянном порядке, в нижнем регистре и без лишних пробелов. Строка является
+    и ключом кэша, и запросом к геокодеру."""
+    keys = [key for key in GEO_FIELDS if key in geo]
+    keys += sorted(key for key in geo if key not in GEO_FIELDS)
+    return ' '.join(' '.join(str(geo[key]).lower().split()) for key in keys)
+
+
+class GeocodingService:
+    """Класс GeocodingService - общий для WeatherState и MapsState геокодер с кэшем.
+    -------------------------------------------------------------------------------
+    Координаты ищутся сначала в LRU-кэше в памяти, затем в постоянном кэше на диске (если задан
+    db_path) и только потом запрашиваются у Яндекс.Геокодера. Одновременные запросы одного места
+    объединяются в один (flights). Когда квота геокодера на исходе или геокодер недоступен
+    (upstream.degraded), отдаются и устаревшие координаты из кэшей.
+    -------------------------------------------------------------------------------
+    Методы
+        lookup(place) - возвращает координаты (lon, lat) места place в виде строк или None,
+            если место не найдено. place - строка, которую вернула normalize_geo.
+        lookup_async(place) - асинхронная версия lookup.
+        stats() - возвращает счетчики попаданий и промахов кэшей и число запросов к геокодеру."""
+
+    def __init__(self, api_key: str, memory_size: int = 4096, ttl: float = GEOCODER_TTL,
+                 db_path: str = None):
+        self._api_key = api_key
+        self._memory = LRUCache(memory_size, ttl)
+        self._disk = SqliteCache(db_path, ttl) if db_path else None
+        self._upstream_calls = 0
+        self._lock = threading.Lock()
+
+    def _cached(self, place: str):
+        coords = self._memory.get(place, MISSING)
+        if coords is MISSING and self._disk is not None:
+            coords = self._disk.get(place, MISSING)
+            if coords is not MISSING:
+                coords = tuple(coords)
+                self._memory.set(place, coords)
+        if coords is MISSING and upstream.degraded('geocoder'):
+            coords = self._memory.get_stale(place, MISSING)
+            if coords is MISSING and self._disk is not None:
+                coords = self._disk.get_stale(place, MISSING)
+                coords = tuple(coords) if coords is not MISSING else MISSING
+        return coords
+
+    def _store(self, place: str, coords: tuple):
+        self._memory.set(place, coords)
+        if self._disk is not None:
+            self._disk.set(place, coords)
+
+    def _params(self, place: str) -> dict:
+        with self._lock:
+            self._upstream_calls += 1
+        return {'apikey': self._api_key, 'geocode': place, 'format': 'json'}
+
+    @staticmethod
+    def _parse(response) -> tuple or None:
+        logging.info('Geocoder: %s', response.url)
+        if not response:
+            return None
+        members = response.json()['response']['GeoObjectCollection']['featureMember']
+        if not members:
+            return None
+        lon, lat = members[0]['GeoObject']['Point']['pos'].split()
+        return lon, lat
+
+    def _fetch(self, place: str) -> tuple or None:
+        coords = self._parse(upstream.get('geocoder', '/1.x/', params=self._params(place)))
+        if coords:
+            self._store(place, coords)
+        return coords
+
+    async def _fetch_async(self, place: str) -> tuple or None:
+        coords = self._parse(await upstream.get_async('geocoder', '/1.x/',
+                                                      params=self._params(place)))
+        if coords:
+            self._store(place, coords)
+        return coords
+
+    def lookup(self, place: str) -> tuple or None:
+        coords = self._cached(place)
+        if coords is MISSING:
+            coords = flights.do(('geocoder', place), self._fetch, place)
+        return coords
+
+    async def lookup_async(self, place: str) -> tuple or None:
+        coords = self._cached(place)
+        if coords is MISSING:
+            coords = await flights.do_async(('geocoder', place), self._fetch_async, place)
+        return coords
+
+    def stats(self) -> dict:
+        return {
+            'memory': self._memory.stats(),
+            'disk': self._disk.stats() if self._disk is not None else None,
+            'upstream_calls': self._upstream_calls,
+        }
@@ -0,0 +1,31 @@
+"""Настройки gunicorn для запуска навыка в несколько процессов.
+
+Синхронный режим:
+    gunicorn -c gunicorn.conf.py main:app
+Асинхронный режим:
+    WORKER_CLASS=aiohttp.GunicornWebWorker gunicorn -c gunicorn.conf.py async_main:app
+
+Все процессы (и все машины за балансировщиком) должны работать с общим хранилищем сессий:
+SESSION_STORE=sqlite для нескольких процессов на одной машине или SESSION_STORE=redis
+для нескольких машин."""
+import multiprocessing
+import os
+
+os.environ.setdefault('SESSION_STORE', 'sqlite')
+
+bind = os.getenv('BIND', '0.0.0.0:8989')
+workers = int(os.getenv('WORKERS', multiprocessing.cpu_count()))
+worker_class = os.getenv('WORKER_CLASS', 'gthread')
+threads = int(os.getenv('THREADS', 8))
+timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    if server.cfg.workers > 1 and os.environ['SESSION_STORE'] == 'memory':
+        raise RuntimeError('SESSION_STORE=memory cannot be shared between worker processes, '
+                           'use sqlite or redis')
+    # Квоты ключей внешних API и кэш карт делятся между процессами
+    # (см. upstream_module.QUOTA_SHARES).
+    # Процессы создаются после on_starting и наследуют окружение.
+    os.environ.setdefault('QUOTA_SHARES', str(server.cfg.workers))
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from upstream_module import QUOTA_SHARES, UpstreamError, upstream
+
+# Картинки пользователя, который столько секунд не запрашивал карты, удаляются из памяти навыка
+IMAGE_TTL = float(os.getenv('IMAGE_TTL', 60 * 60))
+# Сколько запросов удаления выполняется одновременно
+IMAGE_DELETE_BATCH = int(os.getenv('IMAGE_DELETE_BATCH', 8))
+IMAGE_REAP_INTERVAL = float(os.getenv('IMAGE_REAP_INTERVAL', 60))
+# Как часто просматривать всю память навыка в поисках картинок, которые никто не учитывает:
+# их оставили перезапуск, деплой или перезапуск процесса gunicorn
+IMAGE_SWEEP_INTERVAL = float(os.getenv('IMAGE_SWEEP_INTERVAL', 60 * 60))
+# Сколько загруженных карт держать для повторного показа. Память навыка ограничена 100 МБ,
+# снимок карты весит 30-80 КБ, поэтому 1000 картинок с запасом в нее помещаются. Память общая
+# для всех процессов навыка, поэтому каждый процесс держит свою долю (см. QUOTA_SHARES).
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', 1000))
+IMAGE_CACHE_SHARE = max(1, IMAGE_CACHE_SIZE // QUOTA_SHARES)
+# Координаты в ключе кэша округляются до 4 знаков - около 10 м
+IMAGE_COORD_PRECISION = 4
+
+
+def map_key(lon, lat, spn: str, layers: str) -> tuple:
+    """Ключ кэша карт: округленные координаты центра, размер области и слои карты."""
+    return (round(float(lon), IMAGE_COORD_PRECISION), round(float(lat), IMAGE_COORD_PRECISION),
+            spn, layers)
+
+
+class ImageReaper:
+    """Класс ImageReaper - учет картинок, загруженных в память навыка, и их фоновое удаление.
+    ----------------------------------------------------------------------------------------
+    Картинки учитываются по пользователям со счетчиком ссылок: одну карту могут смотреть
+    несколько пользователей. Картинка, которую больше никто не видит (пользователю показали
+    новую карту, он вышел из режима карт или ttl секунд не запрашивал карты), остается в кэше
+    карт на maxsize последних мест и удаляется, только когда вытеснена из него. Картинки
+    других пользователей не трогаются. Неудачные удаления повторяются при следующем обходе.
+    Кэш отдает карту не дольше ttl / 2 после загрузки: картинки старше ttl, которые процесс
+    не учитывает, удаляет sweep любого процесса, и к этому времени ни один процесс их уже
+    не показывает.
+    ----------------------------------------------------------------------------------------
+    Методы
+        lookup(key) - возвращает id уже загруженной карты по ключу map_key или None.
+        remember(key, image_id) - кладет загруженную карту в кэш и возвращает id вытесненных
+            картинок, которые можно удалять.
+        track(user_id, image_ids) - запоминает картинки, которые сейчас показаны пользователю,
+            и возвращает id его прежних картинок, которые можно удалять.
+        release(user_id) - забывает все картинки пользователя и возвращает их id.
+        delete(image_ids) - удаляет картинки, одновременно не больше batch_size запросов.
+            Вызывается в фоне через run_in_background, чтобы не задерживать ответ.
+        delete_async(image_ids) - асинхронная версия delete.
+        sweep() - удаляет картинки из памяти навыка, которые загружены раньше чем ttl секунд
+            назад и которые этот процесс не учитывает (не показаны пользователям и не в кэше).
+        start_reaper(interval, sweep_interval) - запускает фоновый поток, который каждые
+            interval секунд удаляет картинки неактивных пользователей, а сразу после запуска
+            и затем каждые sweep_interval секунд вызывает sweep. Запускается при старте
+            навыка и при первом track.
+        stats() - возвращает счетчики кэша карт и число учтенных, удаленных и неудаленных
+            картинок."""
+
+    def __init__(self, access_token: str, images_path: str, ttl: float = IMAGE_TTL,
+                 batch_size: int = IMAGE_DELETE_BATCH, maxsize: int = IMAGE_CACHE_SHARE):
+        self._headers = {'Authorization': f'OAuth {access_token}'}
+        self._images_path = images_path
+        self._ttl = ttl
+        self._batch_size = batch_size
+        self._maxsize = maxsize
+        self._users = OrderedDict()
+        self._refs = {}
+        self._cache = OrderedDict()
+        self._cached_ids = {}
+        self._retry = []
+        self._pool = ThreadPoolExecutor(batch_size, thread_name_prefix='image-delete')
+        self._reaper = None
+        self._lock = threading.Lock()
+        self.tracked = 0
+        self.deleted = 0
+        self.failed = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: tuple) -> str or None:
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[1] <= time.monotonic() - self._ttl / 2:
+                # Карта загружена давно, скоро ее может удалить sweep: загружаем заново,
+                # а прежнюю, если ее никто не смотрит, удалит reaper при следующем обходе
+                del self._cache[key]
+                del self._cached_ids[cached[0]]
+                if not self._refs.get(cached[0]):
+                    self._retry.append(cached[0])
+                cached = None
+            if cached is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached[0]
+
+    def remember(self, key: tuple, image_id: str) -> list:
+        with self._lock:
+            unused = []
+            replaced = self._cache.pop(key, (None,))[0]
+            if replaced is not None and replaced != image_id:
+                # Два пользователя одновременно загрузили одно место, в кэше остается последняя.
+                # Ссылку кэша на прежнюю снимаем, а удаляем ее, только если ее никто не смотрит.
+                del self._cached_ids[replaced]
+                if not self._refs.get(replaced):
+                    unused.append(replaced)
+            self._cache[key] = (image_id, time.monotonic())
+            self._cached_ids[image_id] = key
+            if len(self._cache) > self._maxsize:
+                unused += self._evict(key)
+            return unused
+
+    def _evict(self, new_key: tuple) -> list:
+        """Вытесняет из кэша самые давние карты, которые сейчас никто не смотрит, кроме только
+        что загруженной new_key: ее еще не успели показать."""
+        evicted = []
+        for key, (image_id, _) in self._cache.items():
+            if len(self._cache) - len(evicted) <= self._maxsize:
+                break
+            if key != new_key and not self._refs.get(image_id):
+                evicted.append((key, image_id))
+        for key, image_id in evicted:
+            del self._cache[key]
+            del self._cached_ids[image_id]
+        return [image_id for _, image_id in evicted]
+
+    def _unused(self, image_ids: list) -> list:
+        """Снимает ссылки на картинки и возвращает те, что больше не нужны ни пользователям,
+        ни кэшу. Вызывается под self._lock."""
+        unused = []
+        for image_id in image_ids:
+            refs = self._refs.get(image_id, 0) - 1
+            if refs > 0:
+                self._refs[image_id] = refs
+                continue
+            self._refs.pop(image_id, None)
+            if image_id not in self._cached_ids:
+                unused.append(image_id)
+        return unused
+
+    def track(self, user_id: str, image_ids: list) -> list:
+        with self._lock:
+            _, previous = self._users.pop(user_id, (None, []))
+            self._users[user_id] = (time.monotonic(), image_ids)
+            for image_id in image_ids:
+                self._refs[image_id] = self._refs.get(image_id, 0) + 1
+            self.tracked += len(image_ids)
+            unused = self._unused(previous)
+        if self._reaper is None:
+            self.start_reaper()
+        return unused
+
+    def release(self, user_id: str) -> list:
+        with self._lock:
+            return self._unused(self._users.pop(user_id, (None, []))[1])
+
+    def _expired(self) -> list:
+        """Забирает картинки пользователей, неактивных дольше ttl, и не удаленные с прошлого раза."""
+        border = time.monotonic() - self._ttl
+        with self._lock:
+            image_ids, self._retry = self._retry, []
+            while self._users:
+                user_id, (last_seen, user_images) = next(iter(self._users.items()))
+                if last_seen > border:
+                    break
+                del self._users[user_id]
+                image_ids += self._unused(user_images)
+        return image_ids
+
+    def _done(self, image_id: str, response) -> bool:
+        # 404 - картинки уже нет, повторять нечего
+        if response or response.status_code == 404:
+            return True
+        logging.warning('ImageReaper: %s not deleted, status %s', image_id, response.status_code)
+        return False
+
+    def _delete_one(self, image_id: str) -> bool:
+        try:
+            response = upstream.delete('dialogs', f'{self._images_path}{image_id}',
+                                       headers=self._headers)
+        except UpstreamError as e:
+            logging.warning('ImageReaper: %s not deleted, %r', image_id, e)
+            return False
+        return self._done(image_id, response)
+
+    async def _delete_one_async(self, image_id: str) -> bool:
+        try:
+            response = await upstream.delete_async('dialogs', f'{self._images_path}{image_id}',
+                                                   headers=self._headers)
+        except UpstreamError as e:
+            logging.warning('ImageReaper: %s not deleted, %r', image_id, e)
+            return False
+        return self._done(image_id, response)
+
+    def _count(self, image_ids: list, results: list):
+        failed = [image_id for image_id, ok in zip(image_ids, results) if not ok]
+        with self._lock:
+            self.deleted += len(image_ids) - len(failed)
+            self.failed += len(failed)
+            self._retry += failed
+        logging.info('ImageReaper: deleted %d of %d images', len(image_ids) - len(failed),
+                     len(image_ids))
+
+    def delete(self, image_ids: list):
+        if not image_ids:
+            return
+        self._count(image_ids, list(self._pool.map(self._delete_one, image_ids)))
+
+    async def delete_async(self, image_ids: list):
+        results = []
+        for start in range(0, len(image_ids), self._batch_size):
+            batch = image_ids[start:start + self._batch_size]
+            results += await asyncio.gather(*[self._delete_one_async(image_id)
+                                              for image_id in batch])
+        if image_ids:
+            self._count(image_ids, results)
+
+    def _stored(self) -> list:
+        """Возвращает картинки в памяти навыка: пары (id, время загрузки по time.time())."""
+        response = upstream.get('dialogs', self._images_path, headers=self._headers)
+        if not response:
+            raise UpstreamError(f'dialogs: images status {response.status_code}')
+        stored = []
+        for image in response.json().get('images') or ():
+            try:
+                created = datetime.fromisoformat(image['createdAt'].replace('Z', '+00:00'))
+            except (KeyError, TypeError, ValueError):
+                continue
+            stored.append((image['id'], created.timestamp()))
+        return stored
+
+    def sweep(self):
+        border = time.time() - self._ttl
+        stored = self._stored()
+        with self._lock:
+            known = set(self._refs) | set(self._cached_ids) | set(self._retry)
+        orphans = [image_id for image_id, created in stored
+                   if created < border and image_id not in known]
+        logging.info('ImageReaper: %d of %d stored images are not tracked', len(orphans),
+                     len(stored))
+        self.delete(orphans)
+
+    def start_reaper(self, interval: float = IMAGE_REAP_INTERVAL,
+                     sweep_interval: float = IMAGE_SWEEP_INTERVAL) -> threading.Thread:
+        def reap():
+            swept_at = None
+            while True:
+                if swept_at is None or time.monotonic() - swept_at >= sweep_interval:
+                    swept_at = time.monotonic()
+                    try:
+                        self.sweep()
+                    except Exception as e:
+                        logging.warning('ImageReaper: sweep failed %r', e)
+                time.sleep(interval)
+                try:
+                    self.delete(self._expired())
+                except Exception as e:
+                    logging.warning('ImageReaper: %r', e)
+
+        with self._lock:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=reap, name='image-reaper', daemon=True)
+                self._reaper.start()
+        return self._reaper
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._cache), 'hits': self.hits, 'misses': self.misses,
+                    'users': len(self._users), 'tracked': self.tracked, 'deleted': self.deleted,
+                    'failed': self.failed, 'retry': len(self._retry)}
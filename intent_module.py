@@ -0,0 +1,42 @@
+EXIT = 'exit'
+THANKS = 'thanks'
+TRANSLATE = 'translate'
+# Выбор функции навыка в ChoiceState
+TRANSLATOR = 'translator'
+SCANNER = 'scanner'
+WEATHER = 'weather'
+MAPS = 'maps'
+
+INTENT_WORDS = {
+    EXIT: {'выход', 'пока', 'выйти', 'уйти', 'покинуть'},
+    THANKS: {'спасибо', 'класс', 'круто'},
+    TRANSLATE: {'переведи', 'переведите', 'перевод'},
+    TRANSLATOR: {'переводчик'},
+    SCANNER: {'сканер'},
+    WEATHER: {'погода', 'погоду'},
+    MAPS: {'карты'},
+}
+
+
+def compile_router(intent_words: dict) -> dict:
+    """Сворачивает таблицы ключевых слов в один индекс слово -> множество намерений."""
+    router = {}
+    for intent, words in intent_words.items():
+        for word in words:
+            router[word] = router.get(word, frozenset()) | {intent}
+    return router
+
+
+ROUTER = compile_router(INTENT_WORDS)
+NO_INTENTS = frozenset()
+
+
+def classify(tokens: list) -> frozenset:
+    """Возвращает множество намерений, которые встречаются в словах пользователя. Слова
+    просматриваются один раз, сколько бы таблиц ни было в INTENT_WORDS."""
+    intents = NO_INTENTS
+    for token in tokens:
+        found = ROUTER.get(token)
+        if found is not None:
+            intents = intents | found
+    return intents
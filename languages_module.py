@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+LANGUAGES_PATH = os.path.join(os.path.dirname(__file__), 'languages.json')
+# Не чаще, чем раз в столько секунд, проверяем, не изменился ли файл языков
+RELOAD_CHECK_INTERVAL = 5.0
+
+# name - название языка ("японский"), genitive - форма после "с" ("японского"),
+# from_phrases и to_phrases - обороты, которыми пользователь называет языки в запросе,
+# от длинного к короткому: ("с японского языка", "с японского"), ("на японский язык", "на японский")
+Language = namedtuple('Language', ['iso', 'name', 'genitive', 'from_phrases', 'to_phrases'])
+
+
+def _inflect(name: str, iso: str) -> Language:
+    name = name.lower()
+    genitive = f'{name[:-2]}ого'
+    return Language(iso, name, genitive, (f'с {genitive} языка', f'с {genitive}'),
+                    (f'на {name} язык', f'на {name}'))
+
+
+class LanguageRegistry:
+    """Класс LanguageRegistry - таблица языков переводчика из languages.json.
+    -------------------------------------------------------------------------
+    Файл (в кодировке cp1251) читается при первом обращении, а потом только если изменилось
+    время его модификации. При чтении строятся индексы по названию, по форме после "с" и по коду
+    ISO 639-1, поэтому любой поиск - одно обращение к словарю.
+    -------------------------------------------------------------------------
+    Методы
+        iso(name) - возвращает код языка по названию ("японский") или None.
+        iso_from_genitive(word) - возвращает код языка по форме после "с" ("японского") или None.
+        get(iso) - возвращает Language по коду языка или None."""
+
+    def __init__(self, path: str = LANGUAGES_PATH, check_interval: float = RELOAD_CHECK_INTERVAL):
+        self._path = path
+        self._check_interval = check_interval
+        self._mtime = None
+        self._checked_at = 0.0
+        self._by_iso = {}
+        self._by_name = {}
+        self._by_genitive = {}
+        self._lock = threading.Lock()
+
+    def _load(self, mtime: float):
+        with open(self._path, 'r', encoding='cp1251') as json_file:
+            table = json.load(json_file)
+        by_iso = {iso: _inflect(name, iso) for name, iso in table.items()}
+        self._by_name = {language.name: iso for iso, language in by_iso.items()}
+        self._by_genitive = {language.genitive: iso for iso, language in by_iso.items()}
+        self._by_iso = by_iso
+        self._mtime = mtime
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < self._check_interval:
+            return
+        with self._lock:
+            if self._mtime is not None and now - self._checked_at < self._check_interval:
+                return
+            self._checked_at = now
+            mtime = os.stat(self._path).st_mtime
+            if mtime != self._mtime:
+                self._load(mtime)
+
+    def iso(self, name: str) -> str or None:
+        self._refresh()
+        return self._by_name.get(name.lower())
+
+    def iso_from_genitive(self, word: str) -> str or None:
+        self._refresh()
+        return self._by_genitive.get(word.lower())
+
+    def get(self, iso: str) -> Language or None:
+        self._refresh()
+        return self._by_iso.get(iso)
+
+
+languages = LanguageRegistry()
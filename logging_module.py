@@ -0,0 +1,160 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from serialization_module import dumps
+
+# {pid} в имени файла заменяется на id процесса, чтобы воркеры gunicorn писали и ротировали
+# каждый свой файл: при общем файле каждый воркер ротировал бы его сам, и строки терялись бы.
+# Файлы процессов, которых уже нет, удаляет следующий запущенный процесс (_prune_logs).
+LOG_FILE = os.getenv('LOG_FILE', 'logs-{pid}.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', 5))
+# Сообщения длиннее LOG_PAYLOAD_LIMIT символов (тела запросов и ответов) обрезаются, целиком
+# пишется только доля LOG_PAYLOAD_SAMPLE из них.
+LOG_PAYLOAD_LIMIT = int(os.getenv('LOG_PAYLOAD_LIMIT', 2000))
+LOG_PAYLOAD_SAMPLE = float(os.getenv('LOG_PAYLOAD_SAMPLE', 0.01))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Файл, в который пишутся тела всех запросов Алисы для benchmarks/replay.py (пусто - не писать)
+RECORD_TRAFFIC = os.getenv('RECORD_TRAFFIC', '')
+
+# Атрибуты, которые есть у любой записи лога. Все остальные пришли через extra=...
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message'}
+
+_listeners = []
+_traffic_logger = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись в одну строку JSON: время, уровень, логгер, сообщение и поля из extra.
+    Длинные сообщения обрезаются до payload_limit символов, кроме доли sample_rate из них."""
+
+    def __init__(self, payload_limit: int = LOG_PAYLOAD_LIMIT,
+                 sample_rate: float = LOG_PAYLOAD_SAMPLE):
+        super().__init__()
+        self._payload_limit = payload_limit
+        self._sample_rate = sample_rate
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        if len(message) > self._payload_limit and random.random() >= self._sample_rate:
+            message = f'{message[:self._payload_limit]}... (+{len(message) - self._payload_limit})'
+        data = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                  + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': message,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                data[key] = value if isinstance(value, (str, int, float, bool)) else str(value)
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return dumps(data).decode('utf-8')
+
+
+class OneLineFormatter(logging.Formatter):
+    """Пишет сообщение как есть, в одну строку: тело запроса становится строкой JSONL."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return record.getMessage().replace('\n', ' ')
+
+
+class LazyQueueHandler(QueueHandler):
+    """Кладет запись в очередь как есть, без форматирования. Сообщение собирается из msg и args
+    уже в потоке QueueListener, поэтому аргументы не должны меняться после вызова логгера.
+    Если очередь переполнена, запись отбрасывается, а не задерживает запрос."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _prune_logs(path: str):
+    """Удаляет файлы лога path (вместе с ротированными копиями) процессов, которых уже нет.
+    Иначе каждый перезапуск воркера gunicorn оставлял бы свой набор файлов, и ротация
+    не ограничивала бы место на диске."""
+    if '{pid}' not in path or os.name != 'posix':
+        return
+    prefix, suffix = path.split('{pid}', 1)
+    directory = os.path.dirname(prefix) or '.'
+    pattern = re.compile(re.escape(os.path.basename(prefix)) + r'(\d+)' + re.escape(suffix)
+                         + r'(\.\d+)?$')
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match and int(match.group(1)) != os.getpid() and not _pid_alive(int(match.group(1))):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def _start_queue(logger: logging.Logger, path: str, formatter: logging.Formatter,
+                 max_bytes: int, backups: int):
+    _prune_logs(path)
+    file_handler = RotatingFileHandler(path.format(pid=os.getpid()), maxBytes=max_bytes,
+                                       backupCount=backups, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    logger.addHandler(LazyQueueHandler(log_queue))
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    if not _listeners:
+        atexit.register(shutdown_logging)
+    _listeners.append(listener)
+
+
+def setup_logging(path: str = LOG_FILE, level: str = LOG_LEVEL, max_bytes: int = LOG_MAX_BYTES,
+                  backups: int = LOG_BACKUPS, record_path: str = RECORD_TRAFFIC):
+    """Настраивает корневой логгер: записи уходят в очередь, а в файл с ротацией по размеру
+    их пишет отдельный поток. Если задан record_path, так же включается запись трафика
+    (record_traffic). Повторные вызовы ничего не делают."""
+    global _traffic_logger
+    if _listeners:
+        return
+    root = logging.getLogger()
+    root.setLevel(level)
+    _start_queue(root, path, JsonFormatter(), max_bytes, backups)
+    if record_path:
+        _traffic_logger = logging.getLogger('traffic')
+        _traffic_logger.setLevel(logging.INFO)
+        _traffic_logger.propagate = False
+        _start_queue(_traffic_logger, record_path, OneLineFormatter(), max_bytes, backups)
+
+
+def record_traffic(body: str):
+    """Дописывает тело запроса Алисы строкой в файл записи трафика, если запись включена."""
+    if _traffic_logger is not None:
+        _traffic_logger.info('%s', body)
+
+
+def shutdown_logging():
+    """Дописывает в файлы оставшиеся в очередях записи и останавливает потоки записи."""
+    while _listeners:
+        _listeners.pop().stop()
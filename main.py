@@ -1,35 +1,67 @@
 import logging
 
-from flask import Flask, request
+from flask import Flask, Response, abort, request
 
 from alice_module import *
-from context_module import Context, HelloState
+from context_module import ChoiceState, Context, HelloState, forecasts, images
+from deadline_module import REQUEST_BUDGET, Deadline
+from logging_module import record_traffic, setup_logging
+from metrics_module import is_local, metrics, tracing
+from serialization_module import CONTENT_TYPE, dumps, loads
+from session_module import create_session_store
+from weather_module import WEATHER_REFRESH_TOP
 
-logging.basicConfig(
-    filename="logs.log",
-    format="%(asctime)s %(levelname)s %(name)s %(message)s",
-    level=logging.INFO,
-)
+setup_logging()
 
 app = Flask(__name__)
-sessions = {}
+sessions = create_session_store()
+metrics.register("sessions", lambda: len(sessions))
+if WEATHER_REFRESH_TOP:
+    forecasts.start_refresher()
+# Сразу просматриваем память навыка: картинки, оставленные прошлым запуском, никто не учитывает
+images.start_reaper()
 
 
 @app.route("/post", methods=["POST"])
 def main():
-    logging.info(f"Req: {request.json}")
+    with tracing("X-Trace" in request.headers) as trace, metrics.timer("request", "post"):
+        response = handle_post()
+    if trace is not None:
+        response.headers["X-Trace"] = dumps(trace.to_dict()).decode("utf-8")
+    return response
 
-    alice_req = AliceRequest(request.json)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Метрики процесса в JSON, доступны только с этой же машины."""
+    if not is_local(request.remote_addr, request.headers):
+        abort(404)
+    return Response(dumps(metrics.snapshot()), content_type=CONTENT_TYPE)
+
+
+def handle_post() -> Response:
+    deadline = Deadline(REQUEST_BUDGET)
+    body = request.get_data()
+    text = body.decode("utf-8")
+    logging.info("Req: %s", text)
+    record_traffic(text)
+
+    alice_req = AliceRequest(loads(body))
     alice_resp = AliceResponse(alice_req)
-    if alice_req.is_new_session:
-        cnt = Context(HelloState())
-        sessions[alice_req.user_id] = cnt
-        cnt.handle_dialog(alice_resp, alice_req)
-        logging.info(f"Resp: {alice_resp}")
-        return alice_resp.to_json()
-    sessions[alice_req.user_id].handle_dialog(alice_resp, alice_req)
-    logging.info(f"Resp: {alice_resp} {sessions}")
-    return alice_resp.to_json()
+    session = None if alice_req.is_new_session else sessions.get(alice_req.user_id)
+    if session is None:
+        # Новая сессия или сессия вытеснена из хранилища: новому пользователю здороваемся,
+        # а вернувшегося сразу отправляем выбирать функцию.
+        cnt = Context(HelloState() if alice_req.is_new_session else ChoiceState())
+    else:
+        cnt = Context.from_dict(session)
+    cnt.handle_dialog(alice_resp, alice_req, deadline)
+    data = cnt.to_dict()
+    sessions.set(alice_req.user_id, data)
+    body = alice_resp.to_bytes()
+    logging.info("Resp: %s", alice_resp,
+                 extra={"user_id": alice_req.user_id, "state": data["s"]})
+    return Response(body, content_type=CONTENT_TYPE)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек, в секундах
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# TRACE_REQUESTS=1 включает трассировку каждой реплики, иначе только запросов с заголовком X-Trace
+TRACE_REQUESTS = os.getenv('TRACE_REQUESTS', '') == '1'
+LOCAL_ADDRS = {'127.0.0.1', '::1'}
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Histogram:
+    """Гистограмма задержек с фиксированными корзинами. Запись - один bisect и инкремент,
+    перцентили оцениваются по верхней границе корзины."""
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self._counts[bisect.bisect_left(self._buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q: float) -> float or None:
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return self._buckets[i] if i < len(self._buckets) else float('inf')
+
+    def to_dict(self) -> dict:
+        def ms(seconds):
+            return round(seconds * 1000, 1) if seconds is not None else None
+
+        buckets = {f'le_{ms(b)}ms': c for b, c in zip(self._buckets, self._counts)}
+        buckets['le_inf'] = self._counts[-1]
+        return {
+            'count': self.count,
+            'avg_ms': ms(self.total / self.count) if self.count else None,
+            'p50_ms': ms(self.percentile(0.5)),
+            'p95_ms': ms(self.percentile(0.95)),
+            'p99_ms': ms(self.percentile(0.99)),
+            'buckets': buckets,
+        }
+
+
+class Trace:
+    """Разбивка времени одной реплики: список (этап, миллисекунды) в порядке завершения этапов."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, name: str, seconds: float):
+        self.spans.append((name, round(seconds * 1000, 1)))
+
+    def to_dict(self) -> dict:
+        return {'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                'spans': self.spans}
+
+
+class Metrics:
+    """Класс Metrics - метрики навыка в памяти процесса.
+    -----------------------------------------------------
+    Методы
+        observe(kind, name, seconds) - записывает задержку в гистограмму kind/name (kind - state,
+            upstream или request) и в трассировку текущей реплики, если она включена.
+        timer(kind, name) - контекстный менеджер, который замеряет время блока через observe.
+        incr(counter, name) - увеличивает счетчик ошибок или событий.
+        register(name, fn) - добавляет в снимок значение fn() (размер хранилища сессий,
+            статистику кэшей, квоты), оно вычисляется только при запросе снимка.
+        snapshot() - возвращает все метрики в виде словаря."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind: str, name: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get((kind, name))
+            if histogram is None:
+                histogram = self._histograms[(kind, name)] = Histogram()
+            histogram.observe(seconds)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(f'{kind}:{name}', seconds)
+
+    def timer(self, kind: str, name: str) -> '_Timer':
+        return _Timer(self, kind, name)
+
+    def incr(self, counter: str, name: str, value: int = 1):
+        with self._lock:
+            key = (counter, name)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def register(self, name: str, fn):
+        self._gauges[name] = fn
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            histograms = {}
+            for (kind, name), histogram in self._histograms.items():
+                histograms.setdefault(kind, {})[name] = histogram.to_dict()
+            counters = {}
+            for (counter, name), value in self._counters.items():
+                counters.setdefault(counter, {})[name] = value
+        data = dict(histograms, counters=counters)
+        for name, fn in self._gauges.items():
+            data[name] = fn()
+        return data
+
+
+class _Timer:
+    __slots__ = ('_metrics', '_kind', '_name', '_started')
+
+    def __init__(self, metrics: Metrics, kind: str, name: str):
+        self._metrics = metrics
+        self._kind = kind
+        self._name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.observe(self._kind, self._name, time.perf_counter() - self._started)
+        if exc_type is not None:
+            self._metrics.incr('errors', f'{self._kind}:{self._name}')
+        return False
+
+
+def is_local(remote_addr: str, headers) -> bool:
+    """True, если запрос пришел с этой же машины, а не через прокси вроде ngrok."""
+    return remote_addr in LOCAL_ADDRS and 'X-Forwarded-For' not in headers
+
+
+@contextmanager
+def tracing(enabled: bool = False):
+    """Включает трассировку реплики, если enabled или TRACE_REQUESTS. Отдает Trace или None
+    и пишет разбивку времени в лог по выходу из блока."""
+    if not (enabled or TRACE_REQUESTS):
+        yield None
+        return
+    trace = Trace()
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+        logging.info('Trace: %s', list(trace.spans), extra={'total_ms': trace.to_dict()['total_ms']})
+
+
+metrics = Metrics()
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from deadline_module import run_in_background, run_in_background_async
+from upstream_module import upstream
+
+# Сколько упреждающих задач может выполняться одновременно, лишние просто не запускаются
+PREFETCH_MAX_INFLIGHT = int(os.getenv('PREFETCH_MAX_INFLIGHT', 4))
+# Сколько секунд прогретые данные ждут следующей реплики пользователя. Keep-alive соединения
+# API держат примерно столько же.
+PREFETCH_TTL = float(os.getenv('PREFETCH_TTL', 60))
+
+
+class Prefetcher:
+    """Класс Prefetcher - упреждающее прогревание кэшей и соединений с внешними API.
+    -------------------------------------------------------------------------------
+    Когда пользователь переходит в состояние, его следующая реплика почти наверняка потребует
+    определенных данных (например, погоды в Москве по кнопке-подсказке). Prefetcher заранее
+    запускает их получение в фоне, чтобы реплика обслуживалась из теплого кэша. Одинаковые
+    задачи не повторяются, пока их результат свеж (ttl секунд), одновременно выполняется не
+    больше max_inflight задач. Задачи не запускаются, когда квота нужного API на исходе или
+    API недоступен (upstream.degraded).
+    -------------------------------------------------------------------------------
+    Методы
+        prefetch(key, fn, *args, upstreams) - запускает fn(*args) в фоне (fn может быть
+            корутинной функцией). upstreams - имена всех API, в которые ходит fn.
+        warm(names) - открывает соединения с API names, не расходуя квоту. Соединения
+            прогреваются не чаще раза в ttl секунд и в счетчики used/unused не входят.
+        hit(key) - отмечает, что реплика пользователя запросила данные key. Если они были
+            прогреты, задача считается использованной.
+        stats() - возвращает число запущенных, пропущенных, использованных и неиспользованных
+            задач."""
+
+    def __init__(self, max_inflight: int = PREFETCH_MAX_INFLIGHT, ttl: float = PREFETCH_TTL):
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._ttl = ttl
+        self._warmed = OrderedDict()
+        self._connections = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.skipped = 0
+        self.used = 0
+        self.unused = 0
+        self.connections = 0
+
+    def _expire(self, now: float):
+        """Выбрасывает прогретые ключи, которые так и не пригодились. Вызывается под self._lock."""
+        while self._warmed:
+            key, expires = next(iter(self._warmed.items()))
+            if expires > now:
+                break
+            del self._warmed[key]
+            self.unused += 1
+
+    def _claim(self, key, registry: dict) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if registry.get(key, 0) > now:
+                return False
+            if not self._slots.acquire(blocking=False):
+                self.skipped += 1
+                return False
+            registry[key] = now + self._ttl
+            return True
+
+    def _start(self, fn, args):
+        if asyncio.iscoroutinefunction(fn):
+            run_in_background_async(self._run_async, fn, args)
+        else:
+            run_in_background(self._run, fn, args)
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            logging.info('Prefetch: %r', e)
+        finally:
+            self._slots.release()
+
+    async def _run_async(self, fn, args):
+        try:
+            await fn(*args)
+        except Exception as e:
+            logging.info('Prefetch: %r', e)
+        finally:
+            self._slots.release()
+
+    def prefetch(self, key, fn, *args, upstreams: tuple = ()):
+        if any(upstream.degraded(name) for name in upstreams):
+            return
+        if self._claim(key, self._warmed):
+            with self._lock:
+                self.started += 1
+            self._start(fn, args)
+
+    def warm(self, names: tuple, asynchronous: bool = False):
+        for name in names:
+            if self._claim(name, self._connections):
+                with self._lock:
+                    self.connections += 1
+                self._start(upstream.warm_async if asynchronous else upstream.warm, (name,))
+
+    def hit(self, key):
+        with self._lock:
+            expires = self._warmed.pop(key, None)
+            if expires is None:
+                return
+            if expires > time.monotonic():
+                self.used += 1
+            else:
+                self.unused += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {'started': self.started, 'skipped': self.skipped, 'used': self.used,
+                    'unused': self.unused, 'warm': len(self._warmed),
+                    'connections': self.connections}
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,114 @@
+import threading
+import time
+
+
+def _seconds_to_midnight() -> float:
+    now = time.localtime()
+    return 24 * 60 * 60 - (now.tm_hour * 60 * 60 + now.tm_min * 60 + now.tm_sec)
+
+
+class Quota:
+    """Класс Quota - ограничитель запросов к одному ключу внешнего API.
+    -------------------------------------------------------------------
+    per_minute - сколько запросов в минуту разрешает ключ (None - без ограничения), может быть
+        дробным, когда квоту делят несколько процессов. Запросы расходуют токены из корзины
+        емкостью per_minute (но не меньше одного токена), корзина равномерно пополняется.
+    per_day - сколько запросов в сутки разрешает ключ (None - без ограничения).
+    max_wait - сколько секунд запрос может ждать свободный токен в очереди. 0 - запрос, для
+        которого нет токена, сразу отбрасывается.
+    reserve - доля суточной квоты, при остатке меньше которой near_limit() возвращает True.
+    -------------------------------------------------------------------
+    Очередь устроена через резерв токенов: каждый запрос забирает токен сразу, даже если корзина
+    пуста, и ждет, пока токен "накопится". Поэтому запросы получают токены в порядке очереди
+    и одинаково работают в потоках и в asyncio.
+    -------------------------------------------------------------------
+    Методы
+        acquire(max_wait) - резервирует токен и возвращает, сколько секунд нужно подождать перед
+            запросом, или None, если квота исчерпана или ждать пришлось бы дольше max_wait.
+        retry_after() - через сколько секунд квота снова позволит сделать запрос.
+        exhausted() - True, если суточная квота исчерпана.
+        near_limit() - True, если квота почти исчерпана и ответы лучше брать из кэша,
+            даже устаревшие.
+        stats() - возвращает использование квоты."""
+
+    def __init__(self, per_minute: float = None, per_day: int = None, max_wait: float = 1.0,
+                 reserve: float = 0.1):
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.max_wait = max_wait
+        self._reserve = reserve
+        self._rate = per_minute / 60 if per_minute else None
+        self._capacity = max(per_minute or 0, 1)
+        self._tokens = float(self._capacity if per_minute else 0)
+        self._updated_at = time.monotonic()
+        self._day = time.strftime('%Y-%m-%d')
+        self._used_today = 0
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.shed = 0
+
+    def _refill(self):
+        if self._rate is not None:
+            now = time.monotonic()
+            self._tokens = min(self._capacity,
+                               self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+        day = time.strftime('%Y-%m-%d')
+        if day != self._day:
+            self._day = day
+            self._used_today = 0
+
+    def _day_left(self) -> float:
+        if self.per_day is None:
+            return float('inf')
+        return self.per_day - self._used_today
+
+    def acquire(self, max_wait: float = None) -> float or None:
+        max_wait = self.max_wait if max_wait is None else max_wait
+        with self._lock:
+            self._refill()
+            if self._day_left() <= 0:
+                self.shed += 1
+                return None
+            wait = 0.0
+            if self._rate is not None:
+                wait = max(0.0, (1 - self._tokens) / self._rate)
+                if wait > max_wait:
+                    self.shed += 1
+                    return None
+                self._tokens -= 1
+                self.queued += wait > 0
+            self._used_today += 1
+            return wait
+
+    def retry_after(self) -> float:
+        with self._lock:
+            self._refill()
+            if self._day_left() <= 0:
+                return _seconds_to_midnight()
+            if self._rate is None:
+                return 0.0
+            return max(0.0, (1 - self._tokens) / self._rate)
+
+    def exhausted(self) -> bool:
+        with self._lock:
+            self._refill()
+            return self._day_left() <= 0
+
+    def near_limit(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._rate is not None and self._tokens < 1:
+                return True
+            return self.per_day is not None and self._day_left() <= self.per_day * self._reserve
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'per_minute': self.per_minute,
+                'per_day': self.per_day,
+                'used_today': self._used_today,
+                'tokens': round(self._tokens, 2) if self._rate is not None else None,
+                'queued': self.queued,
+                'shed': self.shed,
+            }
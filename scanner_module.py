@@ -0,0 +1,359 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit, urlunsplit
+
+from cache_module import MISSING, LRUCache, SqliteCache
+from deadline_module import Deadline, current_deadline, run_in_background, run_in_background_async
+from upstream_module import CircuitOpen, QuotaExhausted, UpstreamError, upstream
+
+# Чистый вердикт меняется редко, подозрительный перепроверяем чаще, а неудачную проверку
+# (VirusTotal не принял ссылку) помним недолго, чтобы не долбить API той же ссылкой.
+SCAN_CLEAN_TTL = float(os.getenv('SCAN_CLEAN_TTL', 24 * 60 * 60))
+SCAN_SUSPICIOUS_TTL = float(os.getenv('SCAN_SUSPICIOUS_TTL', 60 * 60))
+SCAN_FAILED_TTL = float(os.getenv('SCAN_FAILED_TTL', 60))
+# Сколько секунд фоновая проверка ждет, пока VirusTotal закончит анализ
+SCAN_POLL_TIMEOUT = float(os.getenv('SCAN_POLL_TIMEOUT', 60))
+SCAN_CACHE_DB = os.getenv('SCAN_CACHE_DB')
+# Сколько проверок идет одновременно. Проверка может минуту ждать квоты VirusTotal, поэтому
+# у проверок свой пул потоков, и всплеск ссылок не задерживает остальные фоновые задачи.
+SCAN_WORKERS = int(os.getenv('SCAN_WORKERS', 4))
+SAFE_RESULTS = {'clean', 'unrated'}
+
+SCANNING = object()
+
+URL_SCHEMES = ('http://', 'https://')
+# Знаки, которыми ссылка в тексте может быть обернута или за которыми может идти
+_OPENING = '([{<«„"\''
+_CLOSING = '.,;:!?)]}>»“"\''
+# Символы пути и запроса, которые не нужно экранировать (RFC 3986: unreserved, sub-delims,
+# ':', '@', '/', '?' и уже экранированные последовательности)
+_SAFE_PATH = "/%:@!$&'()*+,;=-._~"
+_SAFE_QUERY = _SAFE_PATH + '?'
+
+
+def _ascii_host(host: str) -> str or None:
+    """Проверяет имя хоста и возвращает его в ASCII-виде (кириллические домены - в punycode),
+    или None, если это не похоже на имя хоста с доменом верхнего уровня. Время работы
+    линейно по длине host."""
+    host = host.rstrip('.').lower()
+    if not host or len(host) > 253:
+        return None
+    labels = host.split('.')
+    if len(labels) < 2:
+        return None
+    if all(label.isdigit() for label in labels):
+        return host if len(labels) == 4 and all(int(label) < 256 for label in labels) else None
+    for label in labels:
+        if not label or len(label) > 63 or label[0] == '-' or label[-1] == '-':
+            return None
+        if not label.replace('-', '').isalnum():
+            return None
+    tld = labels[-1]
+    if len(tld) < 2 or not (tld.isalpha() or tld.startswith('xn--')):
+        return None
+    try:
+        return host.encode('idna').decode('ascii')
+    except UnicodeError:
+        return None
+
+
+def normalize_url(url: str) -> str:
+    """Возвращает ссылку в каноническом виде: со схемой, хостом в нижнем регистре и в punycode,
+    без порта по умолчанию, логина и якоря, с экранированными не-ASCII символами пути
+    и запроса. Одна и та же страница, записанная по-разному, дает один ключ кэша."""
+    url = url.strip()
+    if '://' not in url:
+        url = 'http://' + url
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    hostname = (parts.hostname or '').rstrip('.')
+    netloc = _ascii_host(hostname) or hostname
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and (scheme, port) not in (('http', 80), ('https', 443)):
+        netloc += f':{port}'
+    return urlunsplit((scheme, netloc, quote(parts.path, safe=_SAFE_PATH) or '/',
+                       quote(parts.query, safe=_SAFE_QUERY), ''))
+
+
+def _parse_candidate(word: str) -> tuple or None:
+    """Если слово текста - ссылка, возвращает ее так, как она написана (без обрамляющих знаков),
+    и в каноническом виде, иначе None."""
+    word = word.lstrip(_OPENING).rstrip(_CLOSING)
+    lowered = word[:8].lower()
+    has_scheme = False
+    for scheme in URL_SCHEMES:
+        if lowered.startswith(scheme):
+            rest = word[len(scheme):]
+            has_scheme = True
+            break
+    else:
+        if '://' in word:
+            return None
+        rest = word
+    end = len(rest)
+    for delimiter in '/?#':
+        position = rest.find(delimiter, 0, end)
+        if position != -1:
+            end = position
+    userinfo, _, authority = rest[:end].rpartition('@')
+    if userinfo and not has_scheme:
+        # local@host без схемы - адрес электронной почты, а не ссылка
+        return None
+    host, _, port = authority.partition(':')
+    if port and not (port.isdigit() and int(port) < 65536):
+        return None
+    if _ascii_host(host) is None:
+        return None
+    try:
+        return word, normalize_url(word)
+    except ValueError:
+        return None
+
+
+def find_links(text: str, limit: int = None) -> list:
+    """Находит в тексте реплики все ссылки (со схемой http/https или без нее, в том числе
+    с кириллическими доменами, но не адреса почты) и возвращает их так, как они написаны,
+    без повторов (одна страница, записанная по-разному, - одна ссылка) и в порядке появления,
+    не больше limit. Текст разбирается за один проход без регулярных выражений с возвратами,
+    поэтому время работы линейно по длине текста на любом вводе."""
+    links = []
+    seen = set()
+    for word in text.split():
+        if '.' not in word:
+            continue
+        found = _parse_candidate(word)
+        if found is not None and found[1] not in seen:
+            seen.add(found[1])
+            links.append(found[0])
+            if limit is not None and len(links) >= limit:
+                break
+    return links
+
+
+def find_urls(text: str, limit: int = None) -> list:
+    """То же, что find_links, но ссылки возвращаются в каноническом виде normalize_url - ключе
+    кэша вердиктов и запросов к VirusTotal."""
+    return [normalize_url(link) for link in find_links(text, limit)]
+
+
+def is_clean(counts: dict) -> bool:
+    return set(counts) <= SAFE_RESULTS
+
+
+class UrlScanner:
+    """Класс UrlScanner - кэш вердиктов VirusTotal и фоновая проверка ссылок.
+    -------------------------------------------------------------------------
+    Вердикт - количество антивирусов с каждым результатом ({'clean': 70, 'unrated': 5}).
+    Вердикты хранятся по нормализованной ссылке: чистые clean_ttl секунд, подозрительные
+    suspicious_ttl секунд. Если вердикта нет, ссылка отправляется на проверку в фоне: задача
+    отправляет ссылку, опрашивает анализ с растущими паузами и сохраняет итог в кэш.
+    -------------------------------------------------------------------------
+    Методы
+        verdict(url) - возвращает вердикт из кэша, False, если VirusTotal отверг ссылку,
+            или SCANNING, если проверка идет (при необходимости запускает ее). Если вердикта
+            нет, а суточная квота VirusTotal исчерпана, вызывает QuotaExhausted, а если
+            VirusTotal недоступен - CircuitOpen. Если прошлая проверка ссылки сорвалась
+            (таймаут, ответ 5xx, квота), один раз вызывает ее ошибку: такие неудачи в кэш
+            не попадают, и следующий вызов проверяет ссылку заново. Когда квота на исходе
+            или VirusTotal недоступен, отдает и устаревшие вердикты.
+        verdict_async(url) - асинхронная версия verdict.
+        stats() - возвращает счетчики кэша и число запросов к VirusTotal."""
+
+    def __init__(self, api_key: str, maxsize: int = 4096, clean_ttl: float = SCAN_CLEAN_TTL,
+                 suspicious_ttl: float = SCAN_SUSPICIOUS_TTL, failed_ttl: float = SCAN_FAILED_TTL,
+                 poll_timeout: float = SCAN_POLL_TIMEOUT, db_path: str = SCAN_CACHE_DB):
+        self._headers = {'x-apikey': api_key}
+        self._memory = LRUCache(maxsize, clean_ttl)
+        self._disk = SqliteCache(db_path, clean_ttl) if db_path else None
+        self._clean_ttl = clean_ttl
+        self._suspicious_ttl = suspicious_ttl
+        self._failed_ttl = failed_ttl
+        self._poll_timeout = poll_timeout
+        self._scanning = set()
+        self._errors = {}
+        self._max_errors = maxsize
+        self._pool = ThreadPoolExecutor(SCAN_WORKERS, thread_name_prefix='scan')
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.polls = 0
+
+    def _cached(self, url: str):
+        verdict = self._memory.get(url, MISSING)
+        if verdict is MISSING and self._disk is not None:
+            verdict = self._disk.get(url, MISSING)
+            if verdict is not MISSING:
+                self._memory.set(url, verdict)
+        if verdict is MISSING and upstream.degraded('virustotal'):
+            verdict = self._memory.get_stale(url, MISSING)
+            if verdict is MISSING and self._disk is not None:
+                verdict = self._disk.get_stale(url, MISSING)
+        return verdict
+
+    def _store(self, url: str, verdict: dict or bool):
+        if not verdict:
+            ttl = self._failed_ttl
+        else:
+            ttl = self._clean_ttl if is_clean(verdict) else self._suspicious_ttl
+        self._memory.set(url, verdict, ttl)
+        if self._disk is not None:
+            self._disk.set(url, verdict, ttl)
+
+    def _start(self, url: str) -> bool:
+        """Помечает ссылку как проверяемую. Возвращает False, если проверка уже идет.
+        Если суточная квота VirusTotal исчерпана, вызывает QuotaExhausted, если предохранитель
+        VirusTotal не пропустит запрос - CircuitOpen. В состоянии half_open проверка
+        запускается: ее запрос к VirusTotal и будет пробным."""
+        quota = upstream.quota('virustotal')
+        if quota.exhausted():
+            raise QuotaExhausted('virustotal', quota.retry_after())
+        breaker = upstream.breaker('virustotal')
+        if breaker.rejects():
+            raise CircuitOpen('virustotal', breaker.retry_after())
+        with self._lock:
+            if url in self._scanning:
+                return False
+            self._scanning.add(url)
+            self.submitted += 1
+            return True
+
+    def _finish(self, url: str, verdict: dict or bool or None, error: UpstreamError = None):
+        if verdict is not None:
+            self._store(url, verdict)
+        with self._lock:
+            self._scanning.discard(url)
+            if error is not None:
+                self._errors[url] = error
+                if len(self._errors) > self._max_errors:
+                    del self._errors[next(iter(self._errors))]
+
+    def _failure(self, url: str) -> UpstreamError or None:
+        """Возвращает и забывает ошибку последней проверки ссылки, если она сорвалась."""
+        with self._lock:
+            return self._errors.pop(url, None)
+
+    def _poll_delays(self):
+        """Паузы между опросами анализа: 1, 2, 4, 8, 8... секунд, пока не выйдет poll_timeout.
+        Бюджет проверки заменяет бюджет фоновой задачи, чтобы запросы могли дольше ждать
+        очереди квоты."""
+        deadline = Deadline(self._poll_timeout)
+        current_deadline.set(deadline)
+
+        def delays():
+            delay = 1.0
+            while delay < deadline.remaining():
+                yield delay
+                delay = min(delay * 2, 8.0)
+        return delays()
+
+    @staticmethod
+    def _parse_submit(response) -> str or None:
+        """Возвращает id анализа или None, если VirusTotal отверг ссылку (400). Другие ошибки
+        (429, 5xx) к ссылке отношения не имеют, поэтому вызывают UpstreamError."""
+        if response.status_code == 400:
+            return None
+        if response.status_code != 200:
+            raise UpstreamError(f'virustotal: submit status {response.status_code}')
+        return response.json()['data']['id']
+
+    def _parse_analysis(self, response) -> dict or None:
+        """Возвращает вердикт завершенного анализа или None, если анализ еще идет."""
+        with self._lock:
+            self.polls += 1
+        if response.status_code != 200:
+            return None
+        attributes = response.json()['data']['attributes']
+        if attributes.get('status') != 'completed':
+            return None
+        counts = {}
+        for engine in attributes['results'].values():
+            counts[engine['result']] = counts.get(engine['result'], 0) + 1
+        logging.info('Scanner: %s', counts)
+        return counts
+
+    def _scan(self, url: str):
+        verdict = error = None
+        delays = self._poll_delays()
+        try:
+            analysis_id = self._parse_submit(upstream.post('virustotal', '/api/v3/urls',
+                                                           headers=self._headers,
+                                                           data={'url': url}))
+            if analysis_id is None:
+                verdict = False
+            else:
+                for delay in delays:
+                    time.sleep(delay)
+                    verdict = self._parse_analysis(upstream.get(
+                        'virustotal', f'/api/v3/analyses/{analysis_id}', headers=self._headers))
+                    if verdict:
+                        break
+                else:
+                    raise UpstreamError('virustotal: analysis not completed')
+        except UpstreamError as e:
+            # Отказ VirusTotal или квота: ссылка тут ни при чем, поэтому вердикт не запоминаем
+            logging.warning('Scanner: %s %r', url, e)
+            error = e
+        finally:
+            self._finish(url, verdict, error)
+
+    async def _scan_async(self, url: str):
+        verdict = error = None
+        delays = self._poll_delays()
+        try:
+            analysis_id = self._parse_submit(await upstream.post_async(
+                'virustotal', '/api/v3/urls', headers=self._headers, data={'url': url}))
+            if analysis_id is None:
+                verdict = False
+            else:
+                for delay in delays:
+                    await asyncio.sleep(delay)
+                    verdict = self._parse_analysis(await upstream.get_async(
+                        'virustotal', f'/api/v3/analyses/{analysis_id}', headers=self._headers))
+                    if verdict:
+                        break
+                else:
+                    raise UpstreamError('virustotal: analysis not completed')
+        except UpstreamError as e:
+            # Отказ VirusTotal или квота: ссылка тут ни при чем, поэтому вердикт не запоминаем
+            logging.warning('Scanner: %s %r', url, e)
+            error = e
+        finally:
+            self._finish(url, verdict, error)
+
+    def verdict(self, url: str) -> dict or bool:
+        url = normalize_url(url)
+        verdict = self._cached(url)
+        if verdict is not MISSING:
+            return verdict
+        error = self._failure(url)
+        if error is not None:
+            raise error
+        if self._start(url):
+            run_in_background(self._scan, url, executor=self._pool)
+        return SCANNING
+
+    async def verdict_async(self, url: str) -> dict or bool:
+        url = normalize_url(url)
+        verdict = self._cached(url)
+        if verdict is not MISSING:
+            return verdict
+        error = self._failure(url)
+        if error is not None:
+            raise error
+        if self._start(url):
+            run_in_background_async(self._scan_async, url)
+        return SCANNING
+
+    def stats(self) -> dict:
+        return {
+            'memory': self._memory.stats(),
+            'disk': self._disk.stats() if self._disk is not None else None,
+            'submitted': self.submitted,
+            'polls': self.polls,
+        }
@@ -0,0 +1,25 @@
+import json
+
+# orjson в несколько раз быстрее стандартного json и сразу возвращает bytes. Он необязателен:
+# pip install orjson
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+CONTENT_TYPE = 'application/json'
+
+
+def loads(data: bytes or str):
+    """Разбирает JSON из тела запроса (bytes или str)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """Возвращает компактный JSON в UTF-8. Кириллица не экранируется."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
@@ -0,0 +1,237 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from serialization_module import dumps, loads
+
+SESSION_TTL = float(os.getenv('SESSION_TTL', 3600))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 64 * 1024 * 1024))
+SESSION_DB = os.getenv('SESSION_DB', 'sessions.db')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Сколько обращений к SQLite или Redis асинхронный сервер выполняет одновременно
+SESSION_WORKERS = int(os.getenv('SESSION_WORKERS', 8))
+
+_executor = ThreadPoolExecutor(max_workers=SESSION_WORKERS, thread_name_prefix='session')
+
+
+def encode_session(data: dict) -> bytes:
+    # orjson возвращает bytes с запасом около 1 КБ, сессия же занимает десятки байт, а хранится
+    # часами. Копия занимает ровно столько, сколько нужно.
+    return bytes(memoryview(dumps(data)))
+
+
+def decode_session(raw: bytes) -> dict:
+    return loads(raw)
+
+
+class SessionStore(ABC):
+    """Базовый класс хранилища сессий пользователей.
+    ------------------------------------------------
+    Сессия - это небольшой словарь, который возвращает Context.to_dict(). В хранилище он лежит
+    в сериализованном виде, а не как живой объект.
+    ------------------------------------------------
+    Методы
+        get(user_id) - возвращает сессию пользователя или None, если ее нет или она устарела.
+        set(user_id, data) - сохраняет сессию пользователя.
+        delete(user_id) - удаляет сессию пользователя.
+        get_async(user_id), set_async(user_id, data) - версии get и set для асинхронного
+            сервера. Блокирующие обращения к SQLite или Redis выполняются в отдельном пуле
+            потоков, чтобы медленная блокировка или сеть не останавливали event loop.
+        len(store) - количество хранимых сессий."""
+
+    @abstractmethod
+    def get(self, user_id: str) -> dict or None:
+        pass
+
+    @abstractmethod
+    def set(self, user_id: str, data: dict) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, user_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    async def get_async(self, user_id: str) -> dict or None:
+        return await asyncio.get_running_loop().run_in_executor(_executor, self.get, user_id)
+
+    async def set_async(self, user_id: str, data: dict) -> None:
+        await asyncio.get_running_loop().run_in_executor(_executor, self.set, user_id, data)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}: {len(self)} sessions>'
+
+
+class MemorySessionStore(SessionStore):
+    """Хранилище сессий в памяти процесса с вытеснением давно неиспользуемых (LRU).
+    -------------------------------------------------------------------------------
+    ttl - через сколько секунд без обращений сессия считается устаревшей.
+    max_bytes - ограничение на суммарный размер сериализованных сессий, при его превышении
+        вытесняются самые старые сессии.
+    Обращения к памяти не блокируют, поэтому get_async и set_async выполняются сразу, без пула."""
+
+    # Примерный расход памяти на служебные объекты одной записи (узел OrderedDict, кортеж, str)
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, ttl: float = SESSION_TTL, max_bytes: int = SESSION_MAX_BYTES):
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pop(self, user_id):
+        raw, _ = self._sessions.pop(user_id)
+        self._size -= len(user_id) + len(raw) + self.ENTRY_OVERHEAD
+
+    def _evict(self):
+        expired_before = time.monotonic() - self._ttl
+        while self._sessions:
+            user_id, (raw, touched_at) = next(iter(self._sessions.items()))
+            if touched_at > expired_before and self._size <= self._max_bytes:
+                break
+            self._pop(user_id)
+
+    def get(self, user_id: str) -> dict or None:
+        with self._lock:
+            stored = self._sessions.get(user_id)
+            if stored is None:
+                return None
+            if stored[1] <= time.monotonic() - self._ttl:
+                self._pop(user_id)
+                return None
+            self._sessions.move_to_end(user_id)
+            return decode_session(stored[0])
+
+    def set(self, user_id: str, data: dict) -> None:
+        raw = encode_session(data)
+        with self._lock:
+            if user_id in self._sessions:
+                self._pop(user_id)
+            self._sessions[user_id] = (raw, time.monotonic())
+            self._size += len(user_id) + len(raw) + self.ENTRY_OVERHEAD
+            self._evict()
+
+    def delete(self, user_id: str) -> None:
+        with self._lock:
+            if user_id in self._sessions:
+                self._pop(user_id)
+
+    async def get_async(self, user_id: str) -> dict or None:
+        return self.get(user_id)
+
+    async def set_async(self, user_id: str, data: dict) -> None:
+        self.set(user_id, data)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """Хранилище сессий в файле SQLite. Файл может использоваться одновременно несколькими
+    процессами навыка, поэтому любой из них может продолжить диалог пользователя.
+    -------------------------------------------------------------------------------------
+    path - путь к файлу базы данных.
+    ttl - через сколько секунд без обращений сессия считается устаревшей."""
+
+    CLEANUP_EVERY = 1000
+
+    def __init__(self, path: str = SESSION_DB, ttl: float = SESSION_TTL):
+        self._path = path
+        self._ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self._connection().execute('CREATE TABLE IF NOT EXISTS sessions ('
+                                   'user_id TEXT PRIMARY KEY, data BLOB NOT NULL, '
+                                   'touched_at REAL NOT NULL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, user_id: str) -> dict or None:
+        row = self._connection().execute(
+            'SELECT data FROM sessions WHERE user_id = ? AND touched_at > ?',
+            (user_id, time.time() - self._ttl)).fetchone()
+        if row is None:
+            return None
+        return decode_session(row[0])
+
+    def set(self, user_id: str, data: dict) -> None:
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                           (user_id, encode_session(data), time.time()))
+        self._writes += 1
+        if self._writes % self.CLEANUP_EVERY == 0:
+            connection.execute('DELETE FROM sessions WHERE touched_at <= ?',
+                               (time.time() - self._ttl,))
+
+    def delete(self, user_id: str) -> None:
+        self._connection().execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def __repr__(self):
+        return f'<{type(self).__name__}: {self._path}>'
+
+
+class RedisSessionStore(SessionStore):
+    """Хранилище сессий в Redis для запуска навыка на нескольких машинах. Устаревание сессий
+    выполняет сам Redis. Требует пакет redis (pip install redis).
+    ---------------------------------------------------------------------------------------
+    url - адрес Redis.
+    ttl - через сколько секунд без обращений сессия считается устаревшей."""
+
+    PREFIX = 'session:'
+
+    def __init__(self, url: str = REDIS_URL, ttl: float = SESSION_TTL):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._url = url
+        self._ttl = int(ttl)
+
+    def get(self, user_id: str) -> dict or None:
+        raw = self._redis.get(self.PREFIX + user_id)
+        if raw is None:
+            return None
+        return decode_session(raw)
+
+    def set(self, user_id: str, data: dict) -> None:
+        self._redis.set(self.PREFIX + user_id, encode_session(data), ex=self._ttl)
+
+    def delete(self, user_id: str) -> None:
+        self._redis.delete(self.PREFIX + user_id)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self._redis.scan_iter(match=self.PREFIX + '*', count=1000))
+
+    def __repr__(self):
+        return f'<{type(self).__name__}: {self._url}>'
+
+
+def create_session_store(kind: str = None) -> SessionStore:
+    """Создает хранилище сессий по имени: memory (по умолчанию), sqlite или redis.
+    Имя берется из переменной окружения SESSION_STORE, если не передано явно."""
+    kind = kind or os.getenv('SESSION_STORE', 'memory')
+    if kind == 'memory':
+        return MemorySessionStore()
+    if kind == 'sqlite':
+        return SqliteSessionStore()
+    if kind == 'redis':
+        return RedisSessionStore()
+    raise ValueError(f'Unknown session store: {kind}')
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from metrics_module import metrics
+
+
+class SingleFlight:
+    """Класс SingleFlight - объединение одинаковых одновременных запросов к внешним API.
+    ------------------------------------------------------------------------------------
+    Пока запрос с ключом key выполняется, остальные вызовы с тем же ключом не отправляют свой,
+    а ждут его результат (или его исключение). Результат нигде не хранится: следующий вызов
+    после завершения запроса отправит новый, поэтому объединение работает и без кэша.
+    Ключ - кортеж, первый элемент которого - имя API, остальные - нормализованные параметры
+    запроса. Потоки и asyncio-задачи объединяются отдельно друг от друга.
+    ------------------------------------------------------------------------------------
+    Методы
+        do(key, fn, *args) - возвращает fn(*args), выполняя не больше одного вызова на ключ
+            одновременно.
+        do_async(key, fn, *args) - асинхронная версия do, fn - корутинная функция.
+        stats() - возвращает по каждому API число запросов и число вызовов, которые дождались
+            чужого запроса вместо своего."""
+
+    def __init__(self):
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def _count(self, name: str, shared: bool):
+        counts = self._counts.get(name)
+        if counts is None:
+            counts = self._counts[name] = [0, 0]
+        counts[shared] += 1
+
+    def do(self, key: tuple, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+            self._count(key[0], not leader)
+        if not leader:
+            return call.result()
+        try:
+            result = fn(*args)
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def do_async(self, key: tuple, fn, *args):
+        task = self._tasks.get(key)
+        with self._lock:
+            self._count(key[0], task is not None)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {name: {'requests': requests, 'shared': shared}
+                    for name, (requests, shared) in self._counts.items()}
+
+
+flights = SingleFlight()
+metrics.register('single_flight', flights.stats)
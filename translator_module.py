@@ -0,0 +1,131 @@
+import logging
+import threading
+
+from cache_module import MISSING, LRUCache, SqliteCache
+from singleflight_module import flights
+from upstream_module import UpstreamError, upstream
+
+TRANSLATION_TTL = 30 * 24 * 60 * 60
+# Ответ "неверный язык" зависит от того, как пользователь назвал языки, поэтому помним его
+# недолго: этого хватает, чтобы не спрашивать API повторно на "Ну что там?" и ретраях.
+WRONG_LANGUAGE_TTL = 5 * 60
+WRONG_LANGUAGE = 'Вы указали неверный язык, перевод невозможен.'
+TRANSLATOR_HOST = 'translated-mymemory---translation-memory.p.rapidapi.com'
+
+
+def normalize_text(text: str) -> str:
+    """Возвращает текст для перевода в нижнем регистре и без лишних пробелов. Такая строка
+    и ключ кэша, и запрос к переводчику."""
+    return ' '.join(text.lower().split())
+
+
+class TranslationService:
+    """Класс TranslationService - переводчик MyMemory с памятью переводов.
+    ----------------------------------------------------------------------
+    Перевод ищется по (нормализованный текст, язык оригинала, язык перевода) сначала в LRU-кэше
+    в памяти, затем в постоянном кэше на диске (если задан db_path) и только потом запрашивается
+    у API. Одновременные запросы одного перевода объединяются в один (flights). Ответ "неверный
+    язык" кэшируется на negative_ttl секунд. Когда квота переводчика на исходе или API
+    недоступен, отдаются и устаревшие переводы.
+    ----------------------------------------------------------------------
+    Методы
+        translate(text, language_from, language_to) - возвращает перевод текста или
+            WRONG_LANGUAGE, если API вернул текст без изменений.
+        translate_async(text, language_from, language_to) - асинхронная версия translate.
+        stats() - возвращает счетчики попаданий и промахов кэшей и число запросов к API."""
+
+    def __init__(self, token: str, memory_size: int = 8192, ttl: float = TRANSLATION_TTL,
+                 negative_ttl: float = WRONG_LANGUAGE_TTL, db_path: str = None):
+        self._headers = {'x-rapidapi-key': token, 'x-rapidapi-host': TRANSLATOR_HOST}
+        self._memory = LRUCache(memory_size, ttl)
+        self._disk = SqliteCache(db_path, ttl) if db_path else None
+        self._negative_ttl = negative_ttl
+        self._upstream_calls = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(text: str, language_from: str, language_to: str) -> str:
+        return f'{language_from}|{language_to}|{text}'
+
+    def _cached(self, key: str):
+        translated = self._memory.get(key, MISSING)
+        if translated is MISSING and self._disk is not None:
+            translated = self._disk.get(key, MISSING)
+            if translated is not MISSING:
+                self._memory.set(key, translated)
+        if translated is MISSING and upstream.degraded('translator'):
+            translated = self._memory.get_stale(key, MISSING)
+            if translated is MISSING and self._disk is not None:
+                translated = self._disk.get_stale(key, MISSING)
+        return translated
+
+    def _store(self, key: str, translated: str):
+        ttl = self._negative_ttl if translated == WRONG_LANGUAGE else None
+        self._memory.set(key, translated, ttl)
+        if self._disk is not None:
+            self._disk.set(key, translated, ttl)
+
+    def _params(self, text: str, language_from: str, language_to: str) -> dict:
+        with self._lock:
+            self._upstream_calls += 1
+        return {'langpair': f'{language_from}|{language_to}', 'q': text, 'mt': '1',
+                'onlyprivate': '0'}
+
+    @staticmethod
+    def _parse(text: str, response) -> str:
+        """Возвращает перевод из ответа API. Ответы с ошибкой (5xx, 429 и 403 от RapidAPI)
+        и ответы без responseData вызывают UpstreamError."""
+        logging.info('TranslatorRequest: %s', response.url)
+        if not response:
+            raise UpstreamError(f'translator: status {response.status_code}')
+        try:
+            translated = response.json()['responseData']['translatedText']
+        except (ValueError, KeyError, TypeError) as e:
+            raise UpstreamError(f'translator: unexpected response {e!r}') from e
+        if not isinstance(translated, str):
+            raise UpstreamError('translator: unexpected response')
+        if ''.join(translated.split()) == ''.join(text.split()):
+            return WRONG_LANGUAGE
+        return translated
+
+    def _fetch(self, key: str, text: str, language_from: str, language_to: str) -> str:
+        response = upstream.get('translator', '/api/get', headers=self._headers,
+                                params=self._params(text, language_from, language_to))
+        translated = self._parse(text, response)
+        self._store(key, translated)
+        return translated
+
+    async def _fetch_async(self, key: str, text: str, language_from: str,
+                           language_to: str) -> str:
+        response = await upstream.get_async(
+            'translator', '/api/get', headers=self._headers,
+            params=self._params(text, language_from, language_to))
+        translated = self._parse(text, response)
+        self._store(key, translated)
+        return translated
+
+    def translate(self, text: str, language_from: str = 'ru', language_to: str = 'en') -> str:
+        text = normalize_text(text)
+        key = self._key(text, language_from, language_to)
+        translated = self._cached(key)
+        if translated is MISSING:
+            translated = flights.do(('translator', key), self._fetch, key, text, language_from,
+                                    language_to)
+        return translated
+
+    async def translate_async(self, text: str, language_from: str = 'ru',
+                              language_to: str = 'en') -> str:
+        text = normalize_text(text)
+        key = self._key(text, language_from, language_to)
+        translated = self._cached(key)
+        if translated is MISSING:
+            translated = await flights.do_async(('translator', key), self._fetch_async, key, text,
+                                                language_from, language_to)
+        return translated
+
+    def stats(self) -> dict:
+        return {
+            'memory': self._memory.stats(),
+            'disk': self._disk.stats() if self._disk is not None else None,
+            'upstream_calls': self._upstream_calls,
+        }
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from breaker_module import PROBE, CircuitBreaker
+from deadline_module import current_deadline
+from metrics_module import metrics
+from quota_module import Quota
+
+# На сколько процессов делятся квоты ключей (и кэш карт в памяти навыка, см. images_module):
+# каждый процесс считает свою долю. gunicorn.conf.py выставляет число процессов gunicorn;
+# при запуске на нескольких машинах укажите общее число.
+QUOTA_SHARES = int(os.getenv('QUOTA_SHARES', 1))
+
+
+class Upstream:
+    """Настройки одного внешнего API.
+    ---------------------------------
+    name - имя API, по которому к нему обращаются состояния
+    base_url - адрес API (можно переопределить переменной окружения UPSTREAM_<NAME>_URL)
+    connect_timeout - таймаут на установку соединения, в секундах
+    read_timeout - таймаут на чтение ответа, в секундах
+    max_connections - максимальное число одновременных соединений с API
+    per_minute, per_day - квоты ключа API (переопределяются переменными окружения
+        UPSTREAM_<NAME>_PER_MINUTE и UPSTREAM_<NAME>_PER_DAY, 0 - без ограничения). Процесс
+        получает 1/QUOTA_SHARES каждой квоты.
+    max_wait - сколько секунд запрос может ждать в очереди квоты, 0 - сразу отбрасывать
+    breaker - предохранитель API (CircuitBreaker)"""
+
+    def __init__(self, name, base_url, connect_timeout=1.0, read_timeout=2.5, max_connections=10,
+                 per_minute=None, per_day=None, max_wait=1.0):
+        self.name = name
+        self.base_url = os.getenv(f'UPSTREAM_{name.upper()}_URL', base_url).rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        per_minute = float(os.getenv(f'UPSTREAM_{name.upper()}_PER_MINUTE', per_minute or 0))
+        per_day = int(os.getenv(f'UPSTREAM_{name.upper()}_PER_DAY', per_day or 0))
+        self.quota = Quota(per_minute / QUOTA_SHARES or None,
+                           max(1, per_day // QUOTA_SHARES) if per_day else None, max_wait)
+        self.breaker = CircuitBreaker()
+
+
+# Квоты бесплатных тарифов: публичный ключ VirusTotal - 4 запроса в минуту и 500 в сутки
+# (проверки идут в фоне, поэтому им можно долго ждать очереди), HTTP Геокодер - 1000 в сутки,
+# тестовый тариф Яндекс.Погоды - 50 в сутки, базовый тариф MyMemory на RapidAPI - 1000 в сутки.
+UPSTREAMS = {upstream.name: upstream for upstream in [
+    Upstream('virustotal', 'https://www.virustotal.com', read_timeout=2.5, max_connections=4,
+             per_minute=4, per_day=500, max_wait=60),
+    Upstream('geocoder', 'https://geocode-maps.yandex.ru', read_timeout=1.5, per_day=1000),
+    Upstream('weather', 'https://api.weather.yandex.ru', read_timeout=1.5, per_day=50),
+    Upstream('static_maps', 'http://static-maps.yandex.ru', read_timeout=1.5),
+    Upstream('dialogs', 'https://dialogs.yandex.net', read_timeout=2.0),
+    Upstream('translator', 'https://translated-mymemory---translation-memory.p.rapidapi.com',
+             read_timeout=2.0, per_minute=60, per_day=1000),
+]}
+
+
+class UpstreamError(Exception):
+    """Внешний API недоступен: ошибка соединения, таймаут или исчерпан бюджет времени запроса."""
+
+
+class QuotaExhausted(UpstreamError):
+    """Квота ключа внешнего API исчерпана, запрос не отправлялся. retry_after - через сколько
+    секунд квота снова позволит сделать запрос."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f'{name}: quota exhausted, retry after {retry_after:.0f} s')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitOpen(UpstreamError):
+    """API недавно много раз подряд не ответил, и его предохранитель разомкнут: запрос
+    не отправлялся. retry_after - через сколько секунд будет пробный запрос."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f'{name}: circuit open, retry after {retry_after:.0f} s')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class UpstreamStats:
+    """Счетчики вызовов одного внешнего API: количество, ошибки и задержки."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed: float, error: bool):
+        with self._lock:
+            self.calls += 1
+            self.errors += error
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def to_dict(self) -> dict:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_ms': round(self.total_time / self.calls * 1000, 1) if self.calls else 0.0,
+            'max_ms': round(self.max_time * 1000, 1),
+        }
+
+
+class UpstreamResponse:
+    """Полностью прочитанный ответ асинхронного запроса. Повторяет нужную состояниям часть
+    интерфейса requests.Response: status_code, url, json() и приведение к bool."""
+
+    def __init__(self, status_code: int, url: str, content: bytes):
+        self.status_code = status_code
+        self.url = url
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __bool__(self):
+        return self.status_code < 400
+
+
+class UpstreamClient:
+    """Класс UpstreamClient - единая точка выхода состояний навыка во внешние API.
+    ---------------------------------------------------------------------------
+    Для каждого API держит свой пул keep-alive соединений (requests.Session в синхронном режиме
+    и aiohttp.ClientSession в асинхронном), поэтому TCP+TLS рукопожатие выполняется только при
+    открытии нового соединения, а не на каждую реплику пользователя.
+    ---------------------------------------------------------------------------
+    Методы
+        request(name, method, path, **kwargs) - выполняет запрос к API name и возвращает
+            requests.Response.
+        get, post, delete - сокращения для request.
+        request_async(name, method, path, **kwargs) - асинхронная версия request, возвращает
+            UpstreamResponse.
+        get_async, post_async, delete_async - сокращения для request_async.
+        stats() - возвращает словарь со счетчиками вызовов каждого API.
+        quota(name) - возвращает квоту API name.
+        near_limit(name) - True, если квота API name почти исчерпана. Кэши в этом случае отдают
+            даже устаревшие ответы, чтобы сберечь остаток квоты.
+        quota_stats() - возвращает использование квоты каждого API.
+        breaker(name) - возвращает предохранитель API name.
+        is_open(name) - True, если предохранитель API name разомкнут и запросы к нему сразу
+            завершаются CircuitOpen.
+        degraded(name) - True, если API name недоступен или его квота почти исчерпана. Кэши
+            в этом случае отдают даже устаревшие ответы.
+        breaker_stats() - возвращает состояние предохранителя каждого API.
+        warm(name), warm_async(name) - заранее открывают соединение с API name запросом HEAD
+            к корню сайта, не расходуя квоту. Ошибки игнорируются.
+        close_async() - закрывает асинхронные сессии.
+    ---------------------------------------------------------------------------
+    Таймауты запросов ограничиваются оставшимся временем текущего запроса (current_deadline).
+    Ошибки соединения и таймауты превращаются в UpstreamError. После нескольких отказов API
+    подряд (ответ 5xx, ошибка соединения, таймаут API без урезания бюджетом запроса)
+    предохранитель размыкается, и запросы к нему сразу завершаются CircuitOpen.
+    Перед отправкой запрос берет токен квоты API, при необходимости ждет его в очереди (не дольше
+    max_wait и оставшегося времени запроса), а если дождаться нельзя - вызывает QuotaExhausted."""
+
+    def __init__(self, upstreams: dict):
+        self._upstreams = upstreams
+        self._sessions = {}
+        self._async_sessions = {}
+        self._stats = {name: UpstreamStats() for name in upstreams}
+        self._lock = threading.Lock()
+
+    def _session(self, upstream: Upstream) -> requests.Session:
+        session = self._sessions.get(upstream.name)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(upstream.name)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=upstream.max_connections,
+                                          pool_block=True)
+                    session.mount(upstream.base_url, adapter)
+                    self._sessions[upstream.name] = session
+        return session
+
+    def _async_session(self, upstream: Upstream) -> aiohttp.ClientSession:
+        session = self._async_sessions.get(upstream.name)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=upstream.max_connections)
+            timeout = aiohttp.ClientTimeout(sock_connect=upstream.connect_timeout,
+                                            sock_read=upstream.read_timeout)
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._async_sessions[upstream.name] = session
+        return session
+
+    @staticmethod
+    def _acquire(upstream: Upstream, deadline) -> tuple:
+        """Берет разрешение предохранителя и токен квоты. Возвращает (сколько ждать токен,
+        пробный ли это запрос)."""
+        permit = upstream.breaker.allow()
+        if not permit:
+            raise CircuitOpen(upstream.name, upstream.breaker.retry_after())
+        probe = permit is PROBE
+        max_wait = upstream.quota.max_wait
+        try:
+            if deadline is not None:
+                if deadline.expired:
+                    raise UpstreamError(f'{upstream.name}: deadline exceeded')
+                max_wait = min(max_wait, deadline.remaining())
+            wait = upstream.quota.acquire(max_wait)
+            if wait is None:
+                raise QuotaExhausted(upstream.name, upstream.quota.retry_after())
+        except UpstreamError:
+            upstream.breaker.cancel(probe)
+            raise
+        return wait, probe
+
+    def request(self, name: str, method: str, path: str, **kwargs) -> requests.Response:
+        upstream = self._upstreams[name]
+        full_timeout = kwargs.pop('timeout', (upstream.connect_timeout, upstream.read_timeout))
+        deadline = current_deadline.get()
+        wait, probe = self._acquire(upstream, deadline)
+        if wait:
+            time.sleep(wait)
+        timeout = full_timeout
+        if deadline is not None:
+            if deadline.expired:
+                upstream.breaker.cancel(probe)
+                raise UpstreamError(f'{name}: deadline exceeded')
+            timeout = deadline.clamp(timeout)
+        started = time.perf_counter()
+        error = True
+        healthy = None
+        try:
+            response = self._session(upstream).request(method, upstream.base_url + path,
+                                                       timeout=timeout, **kwargs)
+            error = not response
+            healthy = response.status_code < 500
+            return response
+        except requests.Timeout as e:
+            # Таймаут, урезанный оставшимся временем запроса, говорит о нехватке времени,
+            # а не об отказе API: такой результат предохранитель не считает
+            healthy = None if timeout != full_timeout else False
+            raise UpstreamError(f'{name}: {e}') from e
+        except requests.RequestException as e:
+            healthy = False
+            raise UpstreamError(f'{name}: {e}') from e
+        finally:
+            if healthy is None:
+                upstream.breaker.cancel(probe)
+            else:
+                upstream.breaker.record(healthy, probe)
+            elapsed = time.perf_counter() - started
+            self._stats[name].record(elapsed, error)
+            metrics.observe('upstream', name, elapsed)
+            if error:
+                metrics.incr('errors', f'upstream:{name}')
+            logging.info('Upstream: %s %s %s', name, method, path,
+                         extra={'upstream': name, 'ms': round(elapsed * 1000), 'error': error})
+
+    def get(self, name: str, path: str, **kwargs) -> requests.Response:
+        return self.request(name, 'GET', path, **kwargs)
+
+    def post(self, name: str, path: str, **kwargs) -> requests.Response:
+        return self.request(name, 'POST', path, **kwargs)
+
+    def delete(self, name: str, path: str, **kwargs) -> requests.Response:
+        return self.request(name, 'DELETE', path, **kwargs)
+
+    async def request_async(self, name: str, method: str, path: str, **kwargs) -> UpstreamResponse:
+        upstream = self._upstreams[name]
+        deadline = current_deadline.get()
+        wait, probe = self._acquire(upstream, deadline)
+        if wait:
+            await asyncio.sleep(wait)
+        if deadline is not None:
+            if deadline.expired:
+                upstream.breaker.cancel(probe)
+                raise UpstreamError(f'{name}: deadline exceeded')
+            kwargs.setdefault('timeout', aiohttp.ClientTimeout(
+                total=deadline.remaining(), sock_connect=upstream.connect_timeout,
+                sock_read=upstream.read_timeout))
+        started = time.perf_counter()
+        error = True
+        healthy = None
+        try:
+            session = self._async_session(upstream)
+            async with session.request(method, upstream.base_url + path, **kwargs) as response:
+                result = UpstreamResponse(response.status, str(response.url), await response.read())
+            error = not result
+            healthy = result.status_code < 500
+            return result
+        except aiohttp.ServerTimeoutError as e:
+            # Сработали таймауты соединения или чтения самого API
+            healthy = False
+            raise UpstreamError(f'{name}: {e!r}') from e
+        except asyncio.TimeoutError as e:
+            # Сработал total - оставшееся время запроса: предохранитель это не считает
+            raise UpstreamError(f'{name}: {e!r}') from e
+        except aiohttp.ClientError as e:
+            healthy = False
+            raise UpstreamError(f'{name}: {e!r}') from e
+        finally:
+            if healthy is None:
+                upstream.breaker.cancel(probe)
+            else:
+                upstream.breaker.record(healthy, probe)
+            elapsed = time.perf_counter() - started
+            self._stats[name].record(elapsed, error)
+            metrics.observe('upstream', name, elapsed)
+            if error:
+                metrics.incr('errors', f'upstream:{name}')
+            logging.info('Upstream: %s %s %s', name, method, path,
+                         extra={'upstream': name, 'ms': round(elapsed * 1000), 'error': error})
+
+    async def get_async(self, name: str, path: str, **kwargs) -> UpstreamResponse:
+        return await self.request_async(name, 'GET', path, **kwargs)
+
+    async def post_async(self, name: str, path: str, **kwargs) -> UpstreamResponse:
+        return await self.request_async(name, 'POST', path, **kwargs)
+
+    async def delete_async(self, name: str, path: str, **kwargs) -> UpstreamResponse:
+        return await self.request_async(name, 'DELETE', path, **kwargs)
+
+    def warm(self, name: str):
+        upstream = self._upstreams[name]
+        if upstream.breaker.is_open():
+            return
+        try:
+            self._session(upstream).head(upstream.base_url + '/', allow_redirects=False,
+                                         timeout=(upstream.connect_timeout, upstream.read_timeout))
+        except requests.RequestException as e:
+            logging.info('Upstream: %s warm-up failed %r', name, e)
+
+    async def warm_async(self, name: str):
+        upstream = self._upstreams[name]
+        if upstream.breaker.is_open():
+            return
+        try:
+            async with self._async_session(upstream).head(upstream.base_url + '/',
+                                                          allow_redirects=False) as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.info('Upstream: %s warm-up failed %r', name, e)
+
+    def stats(self) -> dict:
+        return {name: stats.to_dict() for name, stats in self._stats.items()}
+
+    def quota(self, name: str) -> Quota:
+        return self._upstreams[name].quota
+
+    def near_limit(self, name: str) -> bool:
+        return self._upstreams[name].quota.near_limit()
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        return self._upstreams[name].breaker
+
+    def is_open(self, name: str) -> bool:
+        return self._upstreams[name].breaker.is_open()
+
+    def degraded(self, name: str) -> bool:
+        return self.is_open(name) or self.near_limit(name)
+
+    def breaker_stats(self) -> dict:
+        return {name: upstream.breaker.stats() for name, upstream in self._upstreams.items()}
+
+    def quota_stats(self) -> dict:
+        return {name: upstream.quota.stats() for name, upstream in self._upstreams.items()}
+
+    async def close_async(self):
+        sessions = list(self._async_sessions.values())
+        self._async_sessions.clear()
+        await asyncio.gather(*[session.close() for session in sessions if not session.closed])
+
+
+upstream = UpstreamClient(UPSTREAMS)
+metrics.register('quotas', upstream.quota_stats)
+metrics.register('breakers', upstream.breaker_stats)
@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter, namedtuple
+
+from cache_module import MISSING, LRUCache
+from singleflight_module import flights
+from upstream_module import upstream
+
+WEATHER_TTL = float(os.getenv('WEATHER_TTL', 15 * 60))
+WEATHER_GRID_STEP = float(os.getenv('WEATHER_GRID_STEP', 0.1))
+WEATHER_REFRESH_TOP = int(os.getenv('WEATHER_REFRESH_TOP', 0))
+WEATHER_REFRESH_INTERVAL = float(os.getenv('WEATHER_REFRESH_INTERVAL', WEATHER_TTL / 2))
+
+Forecast = namedtuple('Forecast', ['temp', 'feels_like', 'condition', 'wind_speed',
+                                   'yesterday_temp'])
+
+
+def grid_cell(lat, lon, step: float = WEATHER_GRID_STEP) -> tuple:
+    """Возвращает ячейку сетки, в которую попадает точка. Прогноз для всех точек ячейки
+    одинаковый, поэтому ячейка - ключ кэша прогнозов."""
+    return round(float(lat) / step), round(float(lon) / step)
+
+
+class ForecastService:
+    """Класс ForecastService - кэш прогнозов Яндекс.Погоды.
+    -----------------------------------------------------
+    Координаты округляются до ячейки сетки со стороной grid_step градусов, прогноз ячейки живет
+    ttl секунд. Одновременные запросы прогноза для одной ячейки объединяются в один запрос
+    к API (flights). Ответ API разбирается один раз в компактную запись Forecast. Когда квота
+    погоды на исходе или API недоступен, отдаются и устаревшие прогнозы, а фоновое обновление
+    не выполняется.
+    -----------------------------------------------------
+    Методы
+        get(lat, lon) - возвращает Forecast для точки или None, если API ответил ошибкой.
+        get_async(lat, lon) - асинхронная версия get.
+        start_refresher(top, interval) - запускает фоновый поток, который каждые interval секунд
+            обновляет прогнозы top самых популярных ячеек, чтобы они не устаревали.
+        stats() - возвращает счетчики кэша и число запросов к API."""
+
+    def __init__(self, api_key: str, ttl: float = WEATHER_TTL, grid_step: float = WEATHER_GRID_STEP,
+                 maxsize: int = 4096):
+        self._api_key = api_key
+        self._grid_step = grid_step
+        self._cache = LRUCache(maxsize, ttl)
+        self._popularity = Counter()
+        self._refresher = None
+        self._lock = threading.Lock()
+        self.upstream_calls = 0
+
+    def _request_args(self, cell: tuple) -> dict:
+        with self._lock:
+            self.upstream_calls += 1
+        return {
+            'headers': {'X-Yandex-API-Key': self._api_key},
+            'params': {'lat': round(cell[0] * self._grid_step, 4),
+                       'lon': round(cell[1] * self._grid_step, 4), 'extra': 'true'},
+        }
+
+    @staticmethod
+    def _parse(response) -> Forecast or None:
+        if response.status_code != 200:
+            return None
+        json_data = response.json()
+        fact = json_data['fact']
+        return Forecast(fact['temp'], fact['feels_like'], fact['condition'], fact['wind_speed'],
+                        json_data['yesterday']['temp'])
+
+    def _fetch(self, cell: tuple) -> Forecast or None:
+        forecast = self._parse(upstream.get('weather', '/v2/forecast', **self._request_args(cell)))
+        if forecast is not None:
+            self._cache.set(cell, forecast)
+        return forecast
+
+    async def _fetch_async(self, cell: tuple) -> Forecast or None:
+        forecast = self._parse(await upstream.get_async('weather', '/v2/forecast',
+                                                        **self._request_args(cell)))
+        if forecast is not None:
+            self._cache.set(cell, forecast)
+        return forecast
+
+    def _cached(self, lat, lon):
+        cell = grid_cell(lat, lon, self._grid_step)
+        if self._refresher is not None:
+            with self._lock:
+                self._popularity[cell] += 1
+        forecast = self._cache.get(cell, MISSING)
+        if forecast is MISSING and upstream.degraded('weather'):
+            forecast = self._cache.get_stale(cell, MISSING)
+        return cell, forecast
+
+    def get(self, lat, lon) -> Forecast or None:
+        cell, forecast = self._cached(lat, lon)
+        if forecast is not MISSING:
+            return forecast
+        return flights.do(('weather', cell), self._fetch, cell)
+
+    async def get_async(self, lat, lon) -> Forecast or None:
+        cell, forecast = self._cached(lat, lon)
+        if forecast is not MISSING:
+            return forecast
+        return await flights.do_async(('weather', cell), self._fetch_async, cell)
+
+    def _refresh_hot(self, top: int):
+        with self._lock:
+            hot = [cell for cell, _ in self._popularity.most_common(top)]
+            self._popularity.clear()
+        for cell in hot:
+            if upstream.degraded('weather'):
+                break
+            try:
+                flights.do(('weather', cell), self._fetch, cell)
+            except Exception as e:
+                logging.warning('ForecastRefresher: %s %r', cell, e)
+
+    def start_refresher(self, top: int = WEATHER_REFRESH_TOP,
+                        interval: float = WEATHER_REFRESH_INTERVAL) -> threading.Thread:
+        def refresh():
+            while True:
+                time.sleep(interval)
+                self._refresh_hot(top)
+
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=refresh, name='forecast-refresher',
+                                               daemon=True)
+            self._refresher.start()
+        return self._refresher
+
+    def stats(self) -> dict:
+        return dict(self._cache.stats(), upstream_calls=self.upstream_calls)